@@ -0,0 +1,460 @@
+import argparse
+import asyncio
+import io
+import logging
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+import zipfile
+from collections import Counter
+from urllib.parse import urlparse
+
+from instagrapi.exceptions import ClientConnectionError, UserNotFound
+from instagrapi.extractors import extract_highlight_v1, extract_media_v1, extract_user_v1
+
+from cache import MediaCache, PersistentLRUCache
+from instagramtools import AsyncInstagramTools, BatchDownloader, InstagramTools, InstagramToolsPool
+from jobqueue import JobQueue
+from jobstore import JobStore
+from ratelimiter import RateLimiter
+from telegramtools import TelegramTools
+
+CDN = 'https://cdn.example.com/'
+
+
+class FakeClient:
+    LATENCY = 0.005
+    PAGE_SIZE = 12
+    MEDIA_SIZE = 16 * 1024
+    COMMENTS = 20
+    COMMENT_PAGE = 20
+    HIGHLIGHTS = 10
+    HIGHLIGHT_ITEMS = 5
+    TAGGED_EVERY = 10
+    ALBUM_EVERY = 5
+    ALBUM_SIZE = 3
+    VIDEO_EVERY = 7
+
+    def __init__(self, profiles, latency=LATENCY, page_size=PAGE_SIZE, media_size=MEDIA_SIZE, error_rate=0,
+                 comments=COMMENTS, seed=0):
+        self.profiles = {str(1000 + index): (username, posts) for index, (username, posts) in enumerate(profiles)}
+        self.latency = latency
+        self.page_size = page_size
+        self.media_size = media_size
+        self.error_rate = error_rate
+        self.comments = comments
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.user_id = '1'
+        self.uuid = 'benchmark'
+        self.request_timeout = 0
+        self.epoch = int(time.time()) - 10 * 365 * 24 * 60 * 60
+
+    def _call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            failed = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise ClientConnectionError('Injected error in {0}'.format(name))
+
+    def _user(self, user_id) -> dict:
+        username, posts = self.profiles[user_id]
+        return {'pk': user_id, 'username': username, 'full_name': username.title(), 'is_private': False,
+                'profile_pic_url': CDN + user_id + '.jpg', 'profile_pic_url_hd': CDN + user_id + '.jpg'}
+
+    def _media(self, user_id, index, tagged=False) -> dict:
+        pk = '{0}{1}{2:06d}'.format(user_id, 9 if tagged else 0, index)
+        candidates = [{'url': CDN + pk + '.jpg', 'width': 1, 'height': 1}]
+        media = {'pk': pk, 'id': '{0}_{1}'.format(pk, user_id), 'code': pk, 'media_type': 1, 'product_type': '',
+                 'taken_at': self.epoch + index * 3600, 'user': self._user(user_id), 'like_count': index,
+                 'caption': {'text': 'Post {0}'.format(index)}, 'comment_count': self.comments,
+                 'image_versions2': {'candidates': candidates}}
+        if index % self.ALBUM_EVERY == 0:
+            media['media_type'] = 8
+            media['carousel_media'] = [{'pk': '{0}{1}'.format(pk, item), 'media_type': 1,
+                                        'image_versions2': {'candidates': [
+                                            {'url': '{0}{1}{2}.jpg'.format(CDN, pk, item), 'width': 1, 'height': 1}]}}
+                                       for item in range(self.ALBUM_SIZE)]
+        elif index % self.VIDEO_EVERY == 0:
+            media['media_type'] = 2
+            media['video_versions'] = [{'url': CDN + pk + '.mp4', 'width': 1, 'height': 1}]
+        return media
+
+    def _highlight(self, user_id, index, items=True) -> dict:
+        pk = '{0}{1:03d}'.format(user_id, index)
+        return {'id': 'highlight:' + pk, 'title': 'Highlight {0}'.format(index), 'created_at': self.epoch + index,
+                'latest_reel_media': self.epoch + index, 'user': self._user(user_id), 'is_pinned_highlight': False,
+                'media_count': self.HIGHLIGHT_ITEMS, 'cover_media': {},
+                'items': [self._story(user_id, '{0}{1:03d}'.format(pk, item)) for item in range(self.HIGHLIGHT_ITEMS)]
+                if items else []}
+
+    def _story(self, user_id, pk) -> dict:
+        return {'pk': pk, 'id': '{0}_{1}'.format(pk, user_id), 'code': pk, 'media_type': 1, 'product_type': '',
+                'taken_at': self.epoch, 'user': self._user(user_id),
+                'image_versions2': {'candidates': [{'url': CDN + pk + '.jpg', 'width': 1, 'height': 1}]}}
+
+    def expected_entries(self, user_id) -> int:
+        username, posts = self.profiles[user_id]
+        entries = 2 + self.HIGHLIGHTS * (1 + self.HIGHLIGHT_ITEMS)
+        for count in (posts, posts // self.TAGGED_EVERY):
+            entries = entries + sum(1 + (self.ALBUM_SIZE if index % self.ALBUM_EVERY == 0 else 1)
+                                    for index in range(count))
+        return entries
+
+    def login(self, username, password) -> bool:
+        self._call('login')
+        return True
+
+    def load_settings(self, path):
+        pass
+
+    def dump_settings(self, path):
+        pass
+
+    def relogin(self):
+        self._call('login')
+
+    def user_id_from_username(self, username) -> str:
+        self._call('user_id_from_username')
+        for user_id, (name, posts) in self.profiles.items():
+            if name == username:
+                return user_id
+        raise UserNotFound(username=username)
+
+    def user_info(self, user_id):
+        self._call('user_info')
+        username, posts = self.profiles[str(user_id)]
+        return extract_user_v1(dict(self._user(str(user_id)), media_count=posts, follower_count=0, following_count=0,
+                                    is_verified=False, is_business=False, biography=''))
+
+    def _page(self, user_id, count, end_cursor, tagged=False) -> tuple:
+        start = int(end_cursor or 0)
+        end = min(count, start + self.page_size)
+        medias = [self._media(user_id, count - 1 - index, tagged) for index in range(start, end)]
+        return medias, str(end) if end < count else ''
+
+    def user_medias_paginated(self, user_id, amount=0, end_cursor=''):
+        self._call('user_medias_paginated')
+        medias, next_cursor = self._page(str(user_id), self.profiles[str(user_id)][1], end_cursor)
+        return [extract_media_v1(media) for media in medias], next_cursor
+
+    def user_highlights(self, user_id):
+        self._call('user_highlights')
+        return [extract_highlight_v1(self._highlight(str(user_id), index, False)) for index in range(self.HIGHLIGHTS)]
+
+    def private_request(self, endpoint, data=None, params=None) -> dict:
+        self._call(endpoint.split('/')[0] + '/' + endpoint.split('/')[-2])
+        if endpoint.startswith('usertags/'):
+            user_id = endpoint.split('/')[1]
+            items, next_cursor = self._page(user_id, self.profiles[user_id][1] // self.TAGGED_EVERY,
+                                            (params or {}).get('max_id'), True)
+            return {'items': items, 'more_available': bool(next_cursor), 'next_max_id': next_cursor}
+        if endpoint.startswith('feed/reels_media'):
+            reels = {}
+            for reel_id in data['user_ids']:
+                if reel_id.startswith('highlight:'):
+                    pk = reel_id.split(':')[1]
+                    reels[reel_id] = self._highlight(pk[:-3], int(pk[-3:]))
+            return {'reels': reels}
+        if endpoint.startswith('media/'):
+            media_id = endpoint.split('/')[1]
+            start = int((params or {}).get('max_id') or 0)
+            end = min(self.comments, start + self.COMMENT_PAGE)
+            user = self._user(media_id.split('_')[1])
+            return {'comments': [{'pk': str(index), 'text': 'Comment {0}'.format(index), 'user': user,
+                                  'created_at_utc': self.epoch, 'content_type': 'comment', 'status': 'Active'}
+                                 for index in range(start, end)],
+                    'has_more_comments': end < self.comments, 'next_max_id': str(end)}
+        raise AssertionError('unexpected endpoint {0}'.format(endpoint))
+
+    def media_pk_from_url(self, url) -> str:
+        return url.rstrip('/').split('/')[-1]
+
+    def media_info(self, media_pk):
+        self._call('media_info')
+        media_pk = str(media_pk)
+        return extract_media_v1(self._media(media_pk[:4], int(media_pk[5:]), media_pk[4] == '9'))
+
+    def write_file(self, url, filename, folder):
+        self._call('download')
+        name = urlparse(str(url)).path.rsplit('/', 1)[1]
+        path = os.path.join(folder, '{0}.{1}'.format(filename, name.rsplit('.', 1)[1]) if filename else name)
+        with open(path, 'wb') as file:
+            file.write(os.urandom(self.media_size))
+        return path
+
+
+class FakeDownloader(BatchDownloader):
+    def __init__(self, client, parallelism=BatchDownloader.PARALLELISM):
+        super().__init__(parallelism)
+        self.client = client
+
+    def download(self, url, filename, folder):
+        return self.client.write_file(url, filename, folder)
+
+
+class FakeBot:
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.uploaded = 0
+        self.entries = 0
+        self.file_ids = 0
+        self.errors = []
+
+    async def request(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def file_id(self) -> str:
+        self.file_ids = self.file_ids + 1
+        return 'file_{0}'.format(self.file_ids)
+
+    async def notify_admin(self, message):
+        await self.request('send_message')
+        self.errors.append(message)
+
+    def upload(self, data):
+        if isinstance(data, bytes):
+            self.uploaded = self.uploaded + len(data)
+            self.entries = self.entries + len(zipfile.ZipFile(io.BytesIO(data)).namelist())
+
+
+class FakeMessage:
+    def __init__(self, bot, chat_id, text=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.from_user = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.document = self.video = None
+        self.photo = []
+
+    async def reply_text(self, text, **kwargs):
+        await self.bot.request('send_message')
+        return FakeMessage(self.bot, self.chat_id, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.bot.request('edit_message_text')
+        self.text = text
+        return self
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        await self.bot.request('send_document')
+        self.bot.upload(document)
+        message = FakeMessage(self.bot, self.chat_id)
+        message.document = types.SimpleNamespace(file_id=self.bot.file_id())
+        return message
+
+    async def reply_media_group(self, medias, **kwargs):
+        await self.bot.request('send_media_group')
+        messages = []
+        for media in medias:
+            if hasattr(media.media, 'input_file_content'):
+                self.bot.uploaded = self.bot.uploaded + len(media.media.input_file_content)
+            message = FakeMessage(self.bot, self.chat_id)
+            message.photo = [types.SimpleNamespace(file_id=self.bot.file_id())]
+            messages.append(message)
+        return messages
+
+
+class Sampler:
+    INTERVAL = 0.25
+
+    def __init__(self, path):
+        self.path = path
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss() -> int:
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def disk(self) -> int:
+        size = 0
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                try:
+                    size = size + os.stat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def sample(self):
+        self.peak_rss = max(self.peak_rss, self.rss())
+        self.peak_disk = max(self.peak_disk, self.disk())
+
+    def _run(self):
+        while not self.stopped.wait(self.INTERVAL):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+
+class Benchmark:
+    def __init__(self, work_dir, sizes, latency=FakeClient.LATENCY, page_size=FakeClient.PAGE_SIZE,
+                 media_size=FakeClient.MEDIA_SIZE, error_rate=0, comments=FakeClient.COMMENTS, upload_latency=0,
+                 workers=AsyncInstagramTools.DEFAULT_WORKERS, pipeline_limits=None):
+        self.work_dir = work_dir
+        self.client = FakeClient([('profile_{0}'.format(size), size) for size in sizes], latency, page_size,
+                                 media_size, error_rate, comments)
+        self.bot = FakeBot(upload_latency)
+        media_cache = MediaCache(os.path.join(work_dir, 'media_cache'), 2048 * 1024 * 1024)
+        rates = {endpoint: 1000000 for endpoint in RateLimiter.RATES}
+        ig_tools = InstagramTools('benchmark', '', media_cache, RateLimiter(rates), None,
+                                  os.path.join(work_dir, 'credential.json'), FakeDownloader(self.client), self.client)
+        self.ig_tools = AsyncInstagramTools(InstagramToolsPool([ig_tools]), workers)
+        self.telegram_tools = TelegramTools(
+            '0:benchmark', 0, self.ig_tools, PersistentLRUCache(os.path.join(work_dir, 'file_ids.json'), 10000),
+            PersistentLRUCache(os.path.join(work_dir, 'watermarks.json'), 10000), None,
+            JobQueue(JobStore(os.path.join(work_dir, 'jobs.sqlite'))), pipeline_limits,
+            work_dir=os.path.join(work_dir, 'work/'))
+        self.telegram_tools.notify_admin = self.bot.notify_admin
+        self.update_id = 0
+
+    def update(self, text):
+        self.update_id = self.update_id + 1
+        return types.SimpleNamespace(update_id=self.update_id, message=FakeMessage(self.bot, self.update_id, text),
+                                     to_dict=lambda: {})
+
+    async def wait(self):
+        while self.telegram_tools.job_queue.jobs:
+            await asyncio.sleep(0.01)
+
+    async def measure(self, name, submit) -> dict:
+        await self.ig_tools.start()
+        calls, requests, errors = sum(self.client.calls.values()), sum(self.bot.calls.values()), len(self.bot.errors)
+        uploaded = self.bot.uploaded
+        with Sampler(self.work_dir) as sampler:
+            started = time.monotonic()
+            await submit()
+            await self.wait()
+            wall_time = time.monotonic() - started
+        calls = sum(self.client.calls.values()) - calls
+        return {'name': name, 'wall_time': wall_time, 'api_calls': calls, 'calls_per_second': calls / wall_time,
+                'bot_requests': sum(self.bot.calls.values()) - requests, 'uploaded': self.bot.uploaded - uploaded,
+                'peak_rss': sampler.peak_rss, 'peak_disk': sampler.peak_disk, 'errors': len(self.bot.errors) - errors}
+
+    async def run_profile(self, username) -> dict:
+        return await self.measure(username, lambda: self.telegram_tools.enqueue('profile', username,
+                                                                                self.update(username)))
+
+    async def run_single(self, count) -> dict:
+        user_id, (username, posts) = next(iter(self.client.profiles.items()))
+
+        async def submit():
+            for index in range(count):
+                url = 'https://www.instagram.com/p/{0}0{1:06d}/'.format(user_id, index % max(posts, 1))
+                await self.telegram_tools.enqueue('media', url, self.update(url))
+
+        result = await self.measure('{0} single posts'.format(count), submit)
+        result['requests_per_second'] = count / result['wall_time']
+        return result
+
+    async def run_batch(self, count) -> dict:
+        user_id, (username, posts) = next(iter(self.client.profiles.items()))
+        text = '\n'.join('https://www.instagram.com/p/{0}0{1:06d}/'.format(user_id, index % max(posts, 1))
+                         for index in range(count))
+        return await self.measure('{0} links in one message'.format(count),
+                                  lambda: self.telegram_tools.resolve_command(self.update(text), None))
+
+    def close(self):
+        self.ig_tools.shutdown()
+        self.telegram_tools.file_id_cache.close()
+        self.telegram_tools.watermarks.close()
+
+
+def format_row(result) -> str:
+    return '{0:<24} {1:>9.2f} {2:>9} {3:>9.1f} {4:>9} {5:>10.1f} {6:>10.1f} {7:>10.1f} {8:>6}'.format(
+        result['name'], result['wall_time'], result['api_calls'], result['calls_per_second'], result['bot_requests'],
+        result['uploaded'] / 1024 / 1024, result['peak_rss'] / 1024 / 1024, result['peak_disk'] / 1024 / 1024,
+        result['errors'])
+
+
+async def run(args):
+    work_dir = tempfile.mkdtemp(prefix='instasub_benchmark_')
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    benchmark = Benchmark(work_dir, args.sizes, args.latency, args.page_size, args.media_size, args.error_rate,
+                          args.comments, args.upload_latency, args.workers)
+    try:
+        print('{0:<24} {1:>9} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10} {7:>10} {8:>6}'.format(
+            'job', 'wall, s', 'api calls', 'calls/s', 'bot reqs', 'upload, MB', 'rss, MB', 'disk, MB', 'errors'))
+        for user_id, (username, posts) in benchmark.client.profiles.items():
+            print(format_row(await benchmark.run_profile(username)))
+        result = await benchmark.run_single(args.single)
+        print(format_row(result))
+        print('Single post requests/sec: {0:.1f}'.format(result['requests_per_second']))
+        print(format_row(await benchmark.run_batch(args.single)))
+        print('API calls by endpoint: {0}'.format(dict(benchmark.client.calls.most_common())))
+    finally:
+        benchmark.close()
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of profile archiving with fake Instagram '
+                                                 'and Telegram backends')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000], help='posts per profile')
+    parser.add_argument('--latency', type=float, default=FakeClient.LATENCY, help='seconds per Instagram call')
+    parser.add_argument('--page-size', type=int, default=FakeClient.PAGE_SIZE)
+    parser.add_argument('--media-size', type=int, default=FakeClient.MEDIA_SIZE, help='bytes per media file')
+    parser.add_argument('--comments', type=int, default=FakeClient.COMMENTS, help='comments per post')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of Instagram calls that fail')
+    parser.add_argument('--upload-latency', type=float, default=0, help='seconds per Telegram request')
+    parser.add_argument('--workers', type=int, default=AsyncInstagramTools.DEFAULT_WORKERS)
+    parser.add_argument('--single', type=int, default=100, help='single post requests to send')
+    logging.getLogger('instasub').setLevel(logging.WARNING)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_profile_archive_is_complete(self):
+        async def run_benchmark():
+            with tempfile.TemporaryDirectory() as work_dir:
+                cwd = os.getcwd()
+                os.chdir(work_dir)
+                benchmark = Benchmark(work_dir, [25], latency=0, media_size=16)
+                try:
+                    result = await benchmark.run_profile('profile_25')
+                    self.assertEqual(benchmark.bot.entries, benchmark.client.expected_entries('1000'))
+                    self.assertEqual(result['api_calls'], sum(benchmark.client.calls.values()) - 1)
+                    self.assertLessEqual(benchmark.bot.calls['edit_message_text'], 2)
+                    result = await benchmark.run_single(5)
+                    self.assertEqual(benchmark.bot.calls['send_media_group'], 5)
+                    result = await benchmark.run_batch(12)
+                    self.assertEqual(result['bot_requests'], 5)
+                    self.assertEqual(benchmark.bot.errors, [])
+                finally:
+                    benchmark.close()
+                    os.chdir(cwd)
+
+        asyncio.run(run_benchmark())
+
+
+if __name__ == '__main__':
+    main()
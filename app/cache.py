@@ -0,0 +1,279 @@
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import OrderedDict
+from pathlib import Path
+
+
+class TTLCache:
+    __MISSING = object()
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.items.get(key, self.__MISSING)
+            if item is not self.__MISSING:
+                expires, value = item
+                if expires > time.monotonic():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def get_or_load(self, key, load):
+        value = self.get(key, self.__MISSING)
+        if value is self.__MISSING:
+            value = load()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.items.clear()
+            else:
+                self.items.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+class PersistentLRUCache:
+    FLUSH_INTERVAL = 10
+
+    def __init__(self, file_name, max_size, flush_interval=FLUSH_INTERVAL):
+        self.file_name = file_name
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(file_name):
+            with open(file_name, encoding='utf-8') as cache_file:
+                self.items.update(json.load(cache_file))
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,), name='cache-flush',
+                                        daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+            self.dirty = True
+
+    def invalidate(self, key=None):
+        with self.lock:
+            if key is None:
+                self.items.clear()
+            else:
+                self.items.pop(key, None)
+            self.dirty = True
+
+    def _flush_periodically(self, interval):
+        while not self.closed.wait(interval):
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                items = list(self.items.items())
+                self.dirty = False
+            temp_file = self.file_name + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as cache_file:
+                json.dump(OrderedDict(items), cache_file)
+            os.replace(temp_file, self.file_name)
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+class MediaCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(cache_dir):
+            entry_dir = os.path.join(cache_dir, name)
+            file = self._entry_file(entry_dir)
+            if '.' in name or file is None:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            stat = os.stat(file)
+            entries.append((stat.st_mtime, entry_dir, stat.st_size))
+        for mtime, entry_dir, size in sorted(entries):
+            self.entries[entry_dir] = size
+            self.size += size
+
+    @staticmethod
+    def _entry_file(entry_dir):
+        if os.path.isdir(entry_dir):
+            for name in os.listdir(entry_dir):
+                return os.path.join(entry_dir, name)
+        return None
+
+    @staticmethod
+    def _link(file, path) -> Path:
+        target = os.path.join(path, os.path.basename(file))
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(file, target)
+        except OSError:
+            shutil.copyfile(file, target)
+        return Path(target)
+
+    def _evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            entry_dir, size = self.entries.popitem(last=False)
+            self.size -= size
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def fetch(self, key, path, download) -> Path:
+        entry_dir = os.path.join(self.cache_dir, hashlib.sha1(str(key).encode()).hexdigest())
+        with self.lock:
+            if entry_dir in self.entries:
+                file = self._entry_file(entry_dir)
+                if file:
+                    self.hits += 1
+                    self.entries.move_to_end(entry_dir)
+                    os.utime(file)
+                    return self._link(file, path)
+            self.misses += 1
+
+        temp_dir = tempfile.mkdtemp(dir=self.cache_dir, suffix='.part')
+        try:
+            file = download(temp_dir)
+            size = os.stat(file).st_size
+            with self.lock:
+                if entry_dir not in self.entries:
+                    shutil.rmtree(entry_dir, ignore_errors=True)
+                    os.replace(temp_dir, entry_dir)
+                    self.entries[entry_dir] = size
+                    self.size += size
+                    self._evict()
+                return self._link(self._entry_file(entry_dir) or file, path)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats(), {'size': 2, 'hits': 1, 'misses': 1})
+
+    def test_ttl_and_invalidate(self):
+        cache = TTLCache(2, 0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+        cache = TTLCache(2, 60)
+        self.assertEqual(cache.get_or_load('a', lambda: 1), 1)
+        self.assertEqual(cache.get_or_load('a', lambda: 2), 1)
+        cache.invalidate('a')
+        self.assertEqual(cache.get_or_load('a', lambda: 2), 2)
+
+
+class TestPersistentLRUCache(unittest.TestCase):
+    def test_survives_restart(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, 'cache.json')
+            cache = PersistentLRUCache(file_name, 2)
+            cache.set('a', [['photo', 'id_a']])
+            cache.set('b', [['video', 'id_b']])
+            cache.set('c', [['photo', 'id_c']])
+            self.assertFalse(os.path.exists(file_name))
+            cache.close()
+            cache = PersistentLRUCache(file_name, 2)
+            self.assertIsNone(cache.get('a'))
+            self.assertEqual(cache.get('c'), [['photo', 'id_c']])
+            cache = PersistentLRUCache(file_name, 2, 0.01)
+            cache.set('d', [['photo', 'id_d']])
+            cache.closed.wait(0.1)
+            self.assertIn('"d"', open(file_name, encoding='utf-8').read())
+            cache.close()
+
+
+class TestMediaCache(unittest.TestCase):
+    @staticmethod
+    def download(data):
+        def wrapped_func(folder):
+            file = os.path.join(folder, 'file.jpg')
+            with open(file, 'wb') as media_file:
+                media_file.write(data)
+            return Path(file)
+
+        return wrapped_func
+
+    def test_fetch_and_evict(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = MediaCache(os.path.join(temp_dir, 'cache'), 6)
+            target = os.path.join(temp_dir, 'request')
+            os.makedirs(target)
+            self.assertEqual(cache.fetch('a', target, self.download(b'aaaa')).read_bytes(), b'aaaa')
+            self.assertEqual(cache.fetch('a', target, self.download(b'bbbb')).read_bytes(), b'aaaa')
+            cache.fetch('b', target, self.download(b'bbbb'))
+            self.assertEqual(cache.stats(), {'size': 1, 'bytes': 4, 'hits': 1, 'misses': 2})
+            self.assertEqual(MediaCache(cache.cache_dir, 6).stats()['bytes'], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
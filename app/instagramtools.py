@@ -1,66 +1,241 @@
 import unittest
+import io
 import os
+import types
+import json
 import logging
+import asyncio
+import random
+import functools
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from instagrapi import Client
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from instagrapi import Client, config
+from instagrapi.extractors import extract_comment, extract_highlight_v1, extract_media_v1, extract_story_v1
 from instagrapi.exceptions import (LoginRequired, MediaNotFound,
-                                   HighlightNotFound, UserNotFound)
+                                   HighlightNotFound, UserNotFound,
+                                   ClientLoginRequired, ChallengeError,
+                                   ReloginAttemptExceeded, ClientConnectionError,
+                                   ClientThrottledError, ClientRequestTimeout,
+                                   ClientIncompleteReadError)
+
+from cache import TTLCache
+from metrics import METRICS
+from ratelimiter import RateLimiter
 
 
 class PrivateAccountException(Exception):
     "You are trying to interact with a private user."
 
 
-def retry_decorator(relogin_attempts=3):
-    def decorator(func):
-        def wrapped_func(*args, **kwargs):
-            for i in range(relogin_attempts):
+class RetryPolicy:
+    ATTEMPTS = 3
+    BUDGET = 6
+    BASE_DELAY = 1
+    MAX_DELAY = 30
+    RETRY_ON = (ClientConnectionError, ClientThrottledError, ClientRequestTimeout, ClientIncompleteReadError,
+                requests.ConnectionError, requests.Timeout, LoginRequired)
+
+    def __init__(self, attempts=ATTEMPTS, budget=BUDGET):
+        self.attempts = attempts
+        self.budget = budget
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.retries = {}
+        self.exhausted = 0
+
+    def delay(self, attempt) -> float:
+        return random.uniform(0, min(self.MAX_DELAY, self.BASE_DELAY * 2 ** attempt))
+
+    @classmethod
+    def is_transient(cls, err) -> bool:
+        if isinstance(err, cls.RETRY_ON):
+            return True
+        response = getattr(err, 'response', None)
+        return response is not None and response.status_code >= 500
+
+    def _count_retry(self, name):
+        with self.lock:
+            self.retries[name] = self.retries.get(name, 0) + 1
+
+    def call(self, func, *args, **kwargs):
+        outermost = getattr(self.local, 'budget', None) is None
+        if outermost:
+            self.local.budget = self.budget
+        try:
+            attempt = 0
+            while True:
                 try:
-                    result = func(*args, **kwargs)
-                except LoginRequired as err:
-                    exception = err
-                    args[0].relogin()
+                    return func(*args, **kwargs)
                 except Exception as err:
-                    exception = err
-                else:
-                    return result
-            raise exception
+                    if not self.is_transient(err):
+                        raise
+                    attempt = attempt + 1
+                    if attempt >= self.attempts or self.local.budget <= 0:
+                        with self.lock:
+                            self.exhausted += 1
+                        raise
+                    self.local.budget -= 1
+                    self._count_retry(func.__name__)
+                    if isinstance(err, LoginRequired):
+                        args[0].relogin()
+                    else:
+                        time.sleep(self.delay(attempt))
+        finally:
+            if outermost:
+                self.local.budget = None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'retries': dict(self.retries), 'exhausted': self.exhausted}
+
+
+RETRY_POLICY = RetryPolicy()
+
+
+def retry_decorator(policy=RETRY_POLICY):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapped_func(*args, **kwargs):
+            return policy.call(func, *args, **kwargs)
 
         return wrapped_func
 
     return decorator
 
 
+class BatchDownloader:
+    PARALLELISM = 4
+    POOL_SIZE = 16
+    TIMEOUT = 60
+
+    def __init__(self, parallelism=PARALLELISM, pool_size=POOL_SIZE):
+        self.parallelism = parallelism
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='download')
+
+    def download(self, url, filename, folder) -> Path:
+        name = urlparse(url).path.rsplit('/', 1)[1]
+        filename = '{0}.{1}'.format(filename, name.rsplit('.', 1)[1]) if filename else name
+        path = Path(folder) / filename
+        with self.session.get(url, stream=True, timeout=self.TIMEOUT) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            with open(path, 'wb') as file:
+                shutil.copyfileobj(response.raw, file)
+        METRICS.inc('instasub_downloaded_bytes_total', path.stat().st_size)
+        return path.resolve()
+
+    def map(self, func, items) -> list:
+        slots = threading.Semaphore(self.parallelism)
+        futures = []
+        for item in items:
+            slots.acquire()
+            future = self.executor.submit(func, item)
+            future.add_done_callback(lambda future: slots.release())
+            futures.append(future)
+        return [future.result() for future in futures]
+
+
 class InstagramTools:
-    def __init__(self, username, password):
+    CACHE_SIZE = 1024
+    HIGHLIGHT_BATCH = 20
+    COMMENT_LIMIT = 500
+    CACHE_TTL = {'user_id': 24 * 60 * 60, 'user_info': 10 * 60, 'media_info': 10 * 60, 'highlight_info': 10 * 60,
+                 'comments': 24 * 60 * 60}
+    SESSION_MAX_AGE = 24 * 60 * 60
+
+    def __init__(self, username, password, media_cache=None, rate_limiter=None, caches=None,
+                 credential_file='/ext/credential.json', downloader=None, client=None):
         self.logger = logging.getLogger('instasub')
-        self.client = Client()
-        self.set_delay(False)
-        self._login(username, password)
-
-    def _login(self, username, password):
-        self.logger.info('Sing in to instagram: username - {0} password - {1}'.format(username, password))
-        self.credential_file = '/ext/credential.json'
-        if os.path.exists(self.credential_file):
+        self.username = username
+        self.password = password
+        self.credential_file = credential_file
+        self.media_cache = media_cache
+        self.downloader = downloader or BatchDownloader()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.caches = caches or self.create_caches()
+        self.client = client or Client()
+        self.client.request_timeout = 0
+        # Client keeps per-request state such as last_json, so only one thread may use it at a time
+        self.client_lock = threading.Lock()
+
+    @classmethod
+    def create_caches(cls) -> dict:
+        return {name: TTLCache(cls.CACHE_SIZE, ttl) for name, ttl in cls.CACHE_TTL.items()}
+
+    def login(self):
+        self.logger.info('Sign in to instagram: username - {0}'.format(self.username))
+        with self.client_lock, METRICS.timer('instasub_instagram_login_seconds'):
+            if not os.path.exists(self.credential_file):
+                self.client.login(self.username, self.password)
+                self.client.dump_settings(self.credential_file)
+                return
+            # a loaded session makes client.login return without a request, so only old sessions are checked
             self.client.load_settings(self.credential_file)
-            res = self.client.login(username, password)
-        else:
-            res = self.client.login(username, password)
+            self.client.login(self.username, self.password)
+            if time.time() - os.path.getmtime(self.credential_file) < self.SESSION_MAX_AGE:
+                return
+            try:
+                self.client.account_info()
+            except (LoginRequired, ClientLoginRequired):
+                self.logger.warning('Cached instagram session of {0} expired'.format(self.username))
+                self.client.relogin()
             self.client.dump_settings(self.credential_file)
 
     def relogin(self):
         self.logger.warning('Relogin to instagram')
+        with self.client_lock:
+            try:
+                self.client.relogin()
+            except Exception as e:
+                print(str(e))
+            self.client.dump_settings(self.credential_file)
+
+    def _locked(self, func, *args, **kwargs):
+        with self.client_lock:
+            return func(*args, **kwargs)
+
+    def _call(self, endpoint, func, *args, **kwargs):
+        METRICS.inc('instasub_instagram_api_calls_total', endpoint=endpoint, method=getattr(func, '__name__', 'call'))
+        if getattr(func, '__self__', None) is self.client:
+            func = functools.partial(self._locked, func)
         try:
-            self.client.relogin()
+            with METRICS.timer('instasub_instagram_api_seconds', endpoint=endpoint):
+                return self.rate_limiter.call(endpoint, func, *args, **kwargs)
         except Exception as e:
-            print(str(e))
-        self.client.dump_settings(self.credential_file)
+            METRICS.inc('instasub_instagram_api_errors_total', endpoint=endpoint, error=type(e).__name__)
+            raise
 
-    def set_delay(self, delay):
-        if delay:
-            self.client.request_timeout = 1
-        else:
-            self.client.request_timeout = 0
+    def invalidate_cache(self, name=None, key=None):
+        for cache_name, cache in self.caches.items():
+            if name is None or name == cache_name:
+                cache.invalidate(key)
+
+    def cache_stats(self) -> dict:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    def _user_info(self, user_id):
+        return self.caches['user_info'].get_or_load(str(user_id),
+                                                    lambda: self._call('info', self.client.user_info, user_id))
+
+    def _media_info(self, media_pk):
+        return self.caches['media_info'].get_or_load(str(media_pk),
+                                                     lambda: self._call('info', self.client.media_info, media_pk))
+
+    def _highlight_info(self, highlight_pk):
+        return self.caches['highlight_info'].get_or_load(
+            str(highlight_pk), lambda: self._call('info', self.client.highlight_info, highlight_pk))
 
     @staticmethod
     def extract_username(username):
@@ -76,55 +251,107 @@ class InstagramTools:
     @retry_decorator()
     def get_user_id(self, username) -> str:
         self.logger.debug('Get user id: {0}'.format(username))
-        return self.client.user_id_from_username(self.extract_username(username))
+        username = self.extract_username(username).lower()
+        return self.caches['user_id'].get_or_load(
+            username, lambda: self._call('info', self.client.user_id_from_username, username))
 
     @retry_decorator()
-    def get_user_medias(self, user_id):
-        self.logger.debug('Get user media: {0}'.format(user_id))
-        if not self.is_public_account(user_id):
+    def get_user_medias_page(self, user_id, end_cursor='') -> tuple:
+        self.logger.debug('Get user media page: {0} {1}'.format(user_id, end_cursor))
+        if not end_cursor and not self.is_public_account(user_id):
             raise PrivateAccountException
-        return self.client.user_medias(user_id)
+        return self._call('feed', self.client.user_medias_paginated, user_id, 0, end_cursor)
 
     @retry_decorator()
-    def get_user_tagged_medias(self, user_id):
-        self.logger.debug('Get user tagged media: {0}'.format(user_id))
-        if not self.is_public_account(user_id):
+    def get_user_tagged_medias_page(self, user_id, end_cursor='') -> tuple:
+        self.logger.debug('Get user tagged media page: {0} {1}'.format(user_id, end_cursor))
+        if not end_cursor and not self.is_public_account(user_id):
             raise PrivateAccountException
-        return self.client.usertag_medias(user_id)
+        result = self._call('feed', self.client.private_request, 'usertags/{0}/feed/'.format(user_id),
+                            params={'max_id': end_cursor})
+        next_cursor = result.get('next_max_id', '') if result.get('more_available') else ''
+        return [extract_media_v1(media) for media in result.get('items', [])], next_cursor
 
     @retry_decorator()
     def is_public_account(self, user_id):
         self.logger.debug('Check account privacy: {0}'.format(user_id))
-        user = self.client.user_info(user_id)
+        user = self._user_info(user_id)
         return not user.is_private
 
+    def _cached_download(self, key, path, download) -> Path:
+        if self.media_cache is None:
+            return download(path)
+        return self.media_cache.fetch(key, path, download)
+
+    def _download_resource(self, resource, filename, path) -> Path:
+        url = resource.video_url if resource.media_type == 2 else resource.thumbnail_url
+        return self._cached_download(resource.pk, path, lambda folder: self._call(
+            'media', self.downloader.download, str(url), filename, folder))
+
+    def _download_resources(self, resources, filename, path) -> list:
+        return self.downloader.map(lambda resource: self._download_resource(resource, filename(resource), path),
+                                   resources)
+
+    @retry_decorator()
+    def get_user_media_count(self, user_id) -> int:
+        self.logger.debug('Get user media count: {0}'.format(user_id))
+        self.invalidate_cache('user_info', str(user_id))
+        return self._user_info(user_id).media_count
+
+    def _reels_media(self, reel_ids) -> dict:
+        data = {
+            'exclude_media_ids': '[]',
+            'supported_capabilities_new': json.dumps(config.SUPPORTED_CAPABILITIES),
+            'source': 'profile',
+            '_uid': str(self.client.user_id),
+            '_uuid': self.client.uuid,
+            'user_ids': [str(reel_id) for reel_id in reel_ids]
+        }
+        return self._call('info', self.client.private_request, 'feed/reels_media/', data).get('reels', {})
+
+    @retry_decorator()
+    def get_reels(self, reel_ids) -> dict:
+        self.logger.debug('Get reels: {0}'.format(reel_ids))
+        reels = self._reels_media(reel_ids)
+        return {reel_id: [extract_story_v1(item) for item in reel.get('items', [])] for reel_id, reel in reels.items()}
+
+    @retry_decorator()
+    def download_story(self, story, path) -> Path:
+        self.logger.debug('Download story: {0}'.format(story.pk))
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        return self._download_resource(story, story.pk, path)
+
     @retry_decorator()
     def download_media(self, media, path) -> list:
         self.logger.debug('Download media: {0}'.format(media))
         if not os.path.exists(path):
-            os.makedirs(path)
-        if media.media_type == 1:
-            return [self.client.photo_download(media.pk, path)]
-        elif media.media_type == 2:
-            return [self.client.video_download(media.pk, path)]
+            os.makedirs(path, exist_ok=True)
+        if (media.media_type == 1 and not media.thumbnail_url) or (media.media_type == 2 and not media.video_url) or (
+                media.media_type == 8 and not media.resources):
+            media = self._media_info(media.pk)
+        if media.media_type in (1, 2):
+            return [self._download_resource(media, '{0}_{1}'.format(media.user.username, media.pk), path)]
         elif media.media_type == 8:
-            return self.client.album_download(media.pk, path)
+            return self._download_resources(media.resources,
+                                            lambda resource: '{0}_{1}'.format(media.user.username, resource.pk), path)
 
-    @retry_decorator()
-    def download_media_from_url(self, url, path) -> list:
-        self.logger.debug('Download media: {0}'.format(url))
-        media_pk = self.client.media_pk_from_url(url)
-        media = self.client.media_info(media_pk)
-        return self.download_media(media, path)
+    def get_media_pk(self, url) -> str:
+        return self.client.media_pk_from_url(url)
+
+    def get_story_pk(self, url) -> str:
+        return self.client.story_pk_from_url(url)
+
+    def get_highlight_pk(self, url) -> str:
+        return self.client.highlight_pk_from_url(url)
 
     @retry_decorator()
-    def get_media_info_from_url(self, url) -> str:
-        self.logger.debug('Get media info: {0}'.format(url))
+    def download_media_from_url(self, url, path) -> tuple:
+        self.logger.debug('Download media: {0}'.format(url))
         media_pk = self.client.media_pk_from_url(url)
-        media = self.client.media_info(media_pk)
-        return self.get_media_info(media)
+        media = self._media_info(media_pk)
+        return self.download_media(media, path), self.get_media_info(media)
 
-    @retry_decorator()
     def get_media_info(self, media) -> str:
         self.logger.debug('Get media info: {0}'.format(media))
         info = 'User: ' + media.user.username
@@ -142,7 +369,7 @@ class InstagramTools:
     @retry_decorator()
     def get_user_info(self, user_id) -> str:
         self.logger.debug('Get user info: {0}'.format(user_id))
-        user_info = self.client.user_info(user_id)
+        user_info = self._user_info(user_id)
         info = 'Id: ' + user_info.pk
         info = info + '\nUsername: ' + user_info.username
         if user_info.full_name:
@@ -167,40 +394,87 @@ class InstagramTools:
     @retry_decorator()
     def get_user_pic(self, user_id, path) -> str:
         self.logger.debug('Get user pic: {0}'.format(user_id))
-        user_info = self.client.user_info(user_id)
-        return self.client.photo_download_by_url(user_info.profile_pic_url_hd, user_id, path)
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        user_info = self._user_info(user_id)
+        return self._call('media', self.downloader.download, str(user_info.profile_pic_url_hd), user_id, path)
 
     @retry_decorator()
-    def get_media_comments(self, media) -> str:
-        self.logger.debug('Get media comments: {0}'.format(media))
-        comments = self.client.media_comments(media.pk, 0)
-        if len(comments) == 0:
-            return ''
-        formatted_result = '\nComments:\n'
-        for comment in comments:
-            if comment.text == '':
-                continue
-            formatted_result = formatted_result + comment.created_at_utc.strftime("%d.%m.%y/%H:%M:%S") + '/'
-            formatted_result = formatted_result + comment.user.username
-            if comment.user.full_name:
-                formatted_result = formatted_result + '/' + comment.user.full_name
-            formatted_result = formatted_result + ': ' + comment.text + '\n'
-        return formatted_result
+    def get_media_comments_page(self, media_id, cursor=None) -> tuple:
+        self.logger.debug('Get media comments page: {0} {1}'.format(media_id, cursor))
+        result = self._call('comments', self.client.private_request, 'media/{0}/comments/'.format(media_id),
+                            params=cursor or None)
+        # same cursor fields as instagrapi's media_comments
+        if result.get('has_more_comments') and result.get('next_max_id'):
+            next_cursor = {'max_id': result['next_max_id']}
+        elif result.get('has_more_headload_comments') and result.get('next_min_id'):
+            next_cursor = {'min_id': result['next_min_id']}
+        else:
+            next_cursor = None
+        return [extract_comment(comment) for comment in result.get('comments', [])], next_cursor
+
+    @staticmethod
+    def format_comment(comment) -> str:
+        author = comment.user.username
+        if comment.user.full_name:
+            author = author + '/' + comment.user.full_name
+        return '{0}/{1}: {2}\n'.format(comment.created_at_utc.strftime("%d.%m.%y/%H:%M:%S"), author, comment.text)
+
+    def write_media_comments(self, media, file, limit=COMMENT_LIMIT):
+        self.logger.debug('Get media comments: {0}'.format(media.pk))
+        if not media.comment_count or limit <= 0:
+            return
+        key = '{0}:{1}:{2}'.format(media.pk, media.comment_count, limit)
+        cached = self.caches['comments'].get(key)
+        if cached is not None:
+            file.write(cached)
+            return
+        pages = []
+        count = 0
+        cursor = None
+        while count < limit:
+            comments, cursor = self.get_media_comments_page(media.id, cursor)
+            lines = [self.format_comment(comment) for comment in comments if comment.text != ''][:limit - count]
+            if lines:
+                pages.append(('\nComments:\n' if count == 0 else '') + ''.join(lines))
+                file.write(pages[-1])
+                count = count + len(lines)
+            if not comments or not cursor:
+                break
+        self.caches['comments'].set(key, ''.join(pages))
 
     @retry_decorator()
     def download_story_from_url(self, url, path) -> Path:
         self.logger.debug('Download story: {0}'.format(url))
         if not os.path.exists(path):
-            os.makedirs(path)
-        story_pk = self.client.story_pk_from_url(url)
-        return self.client.story_download(story_pk, story_pk, path)
+            os.makedirs(path, exist_ok=True)
+        story_pk = str(self.client.story_pk_from_url(url))
+
+        def download(folder):
+            # only the story lookup needs the client, the file itself comes from the CDN
+            story = self._call('info', self.client.story_info, story_pk)
+            story_url = story.video_url if story.media_type == 2 else story.thumbnail_url
+            return self._call('media', self.downloader.download, str(story_url), story_pk, folder)
+
+        return self._cached_download(story_pk, path, download)
 
     @retry_decorator()
     def get_highlights(self, user_id) -> list:
         self.logger.debug('Get user highlights: {0}'.format(user_id))
-        return self.client.user_highlights(user_id)
+        return self._call('feed', self.client.user_highlights, user_id)
 
     @retry_decorator()
+    def get_highlights_items(self, highlights) -> list:
+        self.logger.debug('Get highlights items: {0}'.format([highlight.pk for highlight in highlights]))
+        cache = self.caches['highlight_info']
+        missing = [highlight.pk for highlight in highlights if cache.get(str(highlight.pk)) is None]
+        for i in range(0, len(missing), self.HIGHLIGHT_BATCH):
+            reels = self._reels_media(['highlight:{0}'.format(pk) for pk in missing[i:i + self.HIGHLIGHT_BATCH]])
+            for reel in reels.values():
+                highlight = extract_highlight_v1(reel)
+                cache.set(str(highlight.pk), highlight)
+        return [cache.get(str(highlight.pk)) or highlight for highlight in highlights]
+
     def get_highlight_info(self, highlight) -> str:
         self.logger.debug('Get highlight info: {0}'.format(highlight))
         info = 'User: ' + highlight.user.username
@@ -214,27 +488,193 @@ class InstagramTools:
     def download_highlight(self, highlight, path) -> list:
         self.logger.debug('Download highlight: {0}'.format(highlight))
         if not os.path.exists(path):
-            os.makedirs(path)
-        paths = []
-        info = self.client.highlight_info(highlight.pk)  # doesn't work with highlight.items
-        for item in info.items:
-            if item.media_type == 1:
-                paths.append(self.client.photo_download_by_url(item.thumbnail_url, folder=path))
-            elif item.media_type == 2:
-                paths.append(self.client.video_download_by_url(item.video_url, folder=path))
-        return paths
+            os.makedirs(path, exist_ok=True)
+        if not highlight.items:
+            highlight = self._highlight_info(highlight.pk)  # user_highlights doesn't fill highlight.items
+        return self._download_resources([item for item in highlight.items if item.media_type in (1, 2)],
+                                        lambda item: '', path)
 
     @retry_decorator()
     def download_highlights_from_url(self, url, path):
         self.logger.debug('Download highlight: {0}'.format(url))
-        return self.download_highlight(self.client.highlight_info(self.client.highlight_pk_from_url(url)), path)
+        return self.download_highlight(self._highlight_info(self.client.highlight_pk_from_url(url)), path)
 
 
-class TestInstagramTools(unittest.TestCase):
-    def __init__(self, *args, **kwargs):
-        super(TestInstagramTools, self).__init__(*args, **kwargs)
-        self.ig_tools = InstagramTools('username', 'password')
+class InstagramToolsPool:
+    QUARANTINE_TIME = 30 * 60
+    FAILOVER_EXCEPTIONS = (LoginRequired, ClientLoginRequired, ChallengeError, ReloginAttemptExceeded)
+
+    class Session:
+        def __init__(self, ig_tools):
+            self.ig_tools = ig_tools
+            self.in_flight = 0
+            self.calls = 0
+            self.failures = 0
+            self.quarantined_until = 0
+
+    def __init__(self, sessions):
+        self.logger = logging.getLogger('instasub')
+        self.sessions = [self.Session(ig_tools) for ig_tools in sessions]
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self.sessions[0].ig_tools, name)
+        if not callable(attr):
+            return attr
+
+        def wrapped_func(*args, **kwargs):
+            return self.call(name, *args, **kwargs)
+
+        wrapped_func.__name__ = name
+        return wrapped_func
 
+    def login(self):
+        with ThreadPoolExecutor(max_workers=len(self.sessions)) as executor:
+            futures = [executor.submit(session.ig_tools.login) for session in self.sessions]
+        for session, future in zip(self.sessions, futures):
+            if future.exception() is not None:
+                self.logger.error('Instagram login failed for {0}: {1}'.format(session.ig_tools.username,
+                                                                              future.exception()))
+                with self.lock:
+                    session.failures += 1
+                    session.quarantined_until = time.monotonic() + self.QUARANTINE_TIME
+        if all(future.exception() is not None for future in futures):
+            raise RuntimeError('None of the Instagram accounts could sign in')
+
+    def _acquire(self, tried):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [session for session in self.sessions if session not in tried]
+            healthy = [session for session in candidates if session.quarantined_until <= now]
+            if healthy:
+                session = min(healthy, key=lambda session: (session.in_flight, session.calls))
+            else:
+                session = min(candidates, key=lambda session: session.quarantined_until)
+            session.in_flight += 1
+            session.calls += 1
+            return session
+
+    def call(self, name, *args, **kwargs):
+        tried = []
+        while True:
+            session = self._acquire(tried)
+            try:
+                return getattr(session.ig_tools, name)(*args, **kwargs)
+            except self.FAILOVER_EXCEPTIONS as e:
+                self.logger.warning('Instagram session {0} quarantined: {1}'.format(session.ig_tools.username, str(e)))
+                with self.lock:
+                    session.failures += 1
+                    session.quarantined_until = time.monotonic() + self.QUARANTINE_TIME
+                tried.append(session)
+                if len(tried) == len(self.sessions):
+                    raise
+            finally:
+                with self.lock:
+                    session.in_flight -= 1
+
+    def stats(self) -> list:
+        with self.lock:
+            now = time.monotonic()
+            return [{'username': session.ig_tools.username, 'in_flight': session.in_flight, 'calls': session.calls,
+                     'failures': session.failures, 'healthy': session.quarantined_until <= now,
+                     'rate_limits': session.ig_tools.rate_limiter.stats()} for session in self.sessions]
+
+
+class AsyncInstagramTools:
+    DEFAULT_WORKERS = 8
+    FEED_WORKERS = 2
+    COMMENT_WORKERS = 4
+    # these wait for the slow 'feed' and 'comments' rate limit buckets, so they get their own threads and cannot
+    # starve the rest
+    FEED_METHODS = ('get_user_medias_page', 'get_user_tagged_medias_page', 'get_highlights')
+    COMMENT_METHODS = ('write_media_comments',)
+
+    def __init__(self, ig_tools, workers=DEFAULT_WORKERS, feed_workers=FEED_WORKERS, comment_workers=COMMENT_WORKERS):
+        self.logger = logging.getLogger('instasub')
+        self.ig_tools = ig_tools
+        self.workers = workers
+        self.feed_workers = feed_workers
+        self.comment_workers = comment_workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='instagram')
+        self.feed_executor = ThreadPoolExecutor(max_workers=feed_workers, thread_name_prefix='instagram-feed')
+        self.comment_executor = ThreadPoolExecutor(max_workers=comment_workers,
+                                                   thread_name_prefix='instagram-comments')
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.in_flight = 0
+        self.ready = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.ig_tools, name)
+        if not callable(attr):
+            return attr
+
+        async def wrapped_func(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return wrapped_func
+
+    def _call(self, func, *args, **kwargs):
+        with self.lock:
+            self.queued -= 1
+            self.in_flight += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def start(self) -> asyncio.Future:
+        if self.ready is None or self.ready.cancelled() or (self.ready.done() and self.ready.exception()):
+            self.ready = asyncio.get_running_loop().run_in_executor(self.executor, self.ig_tools.login)
+        return self.ready
+
+    async def wait_ready(self):
+        if self.ready is not None:
+            await asyncio.shield(self.ready)
+
+    async def run(self, func, *args, **kwargs):
+        await self.wait_ready()
+        with self.lock:
+            self.queued += 1
+        loop = asyncio.get_running_loop()
+        name = getattr(func, '__name__', 'call')
+        if name in self.FEED_METHODS:
+            executor = self.feed_executor
+        elif name in self.COMMENT_METHODS:
+            executor = self.comment_executor
+        else:
+            executor = self.executor
+        with METRICS.timer('instasub_instagram_method_seconds', name, method=name):
+            return await loop.run_in_executor(executor, functools.partial(self._call, func, *args, **kwargs))
+
+    async def iterate_pages(self, get_page, user_id, end_cursor=''):
+        while True:
+            medias, next_cursor = await self.run(get_page, user_id, end_cursor)
+            for media in medias:
+                yield media, end_cursor
+            if not medias or not next_cursor:
+                return
+            end_cursor = next_cursor
+
+    def iter_user_medias(self, user_id, end_cursor=''):
+        return self.iterate_pages(self.ig_tools.get_user_medias_page, user_id, end_cursor)
+
+    def iter_user_tagged_medias(self, user_id, end_cursor=''):
+        return self.iterate_pages(self.ig_tools.get_user_tagged_medias_page, user_id, end_cursor)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'workers': self.workers, 'feed_workers': self.feed_workers,
+                    'comment_workers': self.comment_workers, 'queued': self.queued, 'in_flight': self.in_flight}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.feed_executor.shutdown(wait=False, cancel_futures=True)
+        self.comment_executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TestInstagramTools(unittest.TestCase):
     def test_extract_username(self):
         self.assertRaises(UserNotFound, InstagramTools.extract_username, '//')
         self.assertEqual(InstagramTools.extract_username('instagram_username'), 'instagram_username')
@@ -255,5 +695,240 @@ class TestInstagramTools(unittest.TestCase):
         self.assertEqual(InstagramTools.extract_username('instagram.com/instagram_username'), 'instagram_username')
 
 
+class TestAsyncInstagramTools(unittest.TestCase):
+    class Tools:
+        def __init__(self):
+            self.logged_in = threading.Event()
+
+        def login(self):
+            time.sleep(0.05)
+            self.logged_in.set()
+
+        def add(self, a, b):
+            if not self.logged_in.is_set():
+                raise LoginRequired
+            return a + b
+
+        def get_highlights(self, user_id):
+            time.sleep(0.2)
+
+        def write_media_comments(self, media):
+            time.sleep(0.2)
+
+    def test_run_in_executor(self):
+        async_tools = AsyncInstagramTools(self.Tools(), 2, 1, 1)
+
+        async def run():
+            login = async_tools.start()
+            result = await async_tools.add(1, 2)
+            self.assertTrue(login.done())
+            return result
+
+        self.assertEqual(asyncio.run(run()), 3)
+        self.assertEqual(async_tools.stats(), {'workers': 2, 'feed_workers': 1, 'comment_workers': 1, 'queued': 0,
+                                               'in_flight': 0})
+        async_tools.shutdown()
+
+    def test_feed_methods_do_not_starve_others(self):
+        async_tools = AsyncInstagramTools(self.Tools(), 2, 1, 3)
+        async_tools.ig_tools.logged_in.set()
+
+        async def run():
+            highlights = [asyncio.create_task(async_tools.get_highlights(i)) for i in range(3)]
+            comments = asyncio.gather(*(async_tools.write_media_comments(i) for i in range(3)))
+            started = time.monotonic()
+            self.assertEqual(await async_tools.add(1, 2), 3)
+            elapsed = time.monotonic() - started
+            await comments
+            comments_elapsed = time.monotonic() - started
+            await asyncio.gather(*highlights)
+            return elapsed, comments_elapsed
+
+        elapsed, comments_elapsed = asyncio.run(run())
+        self.assertLess(elapsed, 0.1)
+        self.assertLess(comments_elapsed, 0.4)
+        async_tools.shutdown()
+
+
+class TestClientLock(unittest.TestCase):
+    class Client:
+        def __init__(self):
+            self.last_json = None
+
+        def user_info(self, user_id):
+            self.last_json = user_id
+            time.sleep(0.01)
+            return self.last_json
+
+    def test_concurrent_calls(self):
+        ig_tools = InstagramTools('user', 'password', rate_limiter=RateLimiter({'info': 1000}), client=self.Client())
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: ig_tools._call('info', ig_tools.client.user_info, i), range(16)))
+        self.assertEqual(results, list(range(16)))
+
+    def test_downloads_do_not_hold_the_lock(self):
+        class Client:
+            def user_info(self, user_id):
+                return types.SimpleNamespace(profile_pic_url_hd='https://cdn/{0}.jpg'.format(user_id))
+
+            def story_pk_from_url(self, url):
+                return url.rstrip('/').split('/')[-1]
+
+            def story_info(self, story_pk):
+                return types.SimpleNamespace(media_type=1, thumbnail_url='https://cdn/{0}.jpg'.format(story_pk))
+
+        class Downloader(BatchDownloader):
+            def download(self, url, filename, folder):
+                locked.append(ig_tools.client_lock.locked())
+                return Path(folder) / url.rsplit('/', 1)[1]
+
+        locked = []
+        ig_tools = InstagramTools('user', 'password', rate_limiter=RateLimiter({'info': 1000, 'media': 1000}),
+                                  downloader=Downloader(), client=Client())
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(ig_tools.get_user_pic('1', path), Path(path) / '1.jpg')
+            self.assertEqual(ig_tools.download_story_from_url('https://www.instagram.com/stories/user/2/', path),
+                             Path(path) / '2.jpg')
+        self.assertEqual(locked, [False, False])
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_shared_budget(self):
+        policy = RetryPolicy(attempts=3, budget=2)
+        policy.BASE_DELAY = 0
+        calls = []
+
+        @retry_decorator(policy)
+        def inner():
+            calls.append('inner')
+            raise ClientConnectionError
+
+        @retry_decorator(policy)
+        def outer():
+            return inner()
+
+        self.assertRaises(ClientConnectionError, outer)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(policy.stats(), {'retries': {'inner': 2}, 'exhausted': 2})
+
+    def test_only_transient_errors_are_retried(self):
+        policy = RetryPolicy()
+        policy.BASE_DELAY = 0
+        calls = []
+
+        def http_error(status_code):
+            return requests.HTTPError(response=types.SimpleNamespace(status_code=status_code))
+
+        @retry_decorator(policy)
+        def fail(err):
+            calls.append(err)
+            raise err
+
+        for err in (PrivateAccountException(), KeyError('pk'), http_error(404)):
+            self.assertRaises(type(err), fail, err)
+        self.assertEqual(len(calls), 3)
+        self.assertRaises(requests.HTTPError, fail, http_error(503))
+        self.assertEqual(len(calls), 3 + policy.ATTEMPTS)
+
+
+class TestInstagramToolsPool(unittest.TestCase):
+    class Tools:
+        rate_limiter = RateLimiter()
+
+        def __init__(self, username, error=None):
+            self.username = username
+            self.error = error
+
+        def get_username(self):
+            if self.error:
+                raise self.error
+            return self.username
+
+    def test_failover(self):
+        pool = InstagramToolsPool([self.Tools('first', LoginRequired()), self.Tools('second')])
+        self.assertEqual(pool.get_username(), 'second')
+        self.assertEqual(pool.get_username(), 'second')
+        self.assertEqual([session['healthy'] for session in pool.stats()], [False, True])
+        self.assertEqual([session['calls'] for session in pool.stats()], [1, 2])
+
+
+class TestBatchDownloader(unittest.TestCase):
+    def test_map_keeps_order_and_parallelism(self):
+        downloader = BatchDownloader(parallelism=3)
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def fetch(item):
+            with lock:
+                active.append(item)
+                peak.append(len(active))
+            time.sleep(0.01 * (5 - item))
+            with lock:
+                active.remove(item)
+            return item
+
+        self.assertEqual(downloader.map(fetch, range(5)), [0, 1, 2, 3, 4])
+        self.assertEqual(max(peak), 3)
+
+
+class TestMediaComments(unittest.TestCase):
+    class Client:
+        def __init__(self, pages):
+            self.pages = pages
+            self.params = []
+
+        def private_request(self, endpoint, data=None, params=None):
+            self.params.append(params)
+            return self.pages[len(self.params) - 1]
+
+    def test_pages_limit_and_cache(self):
+        user = {'pk': '1', 'username': 'user', 'full_name': '', 'profile_pic_url': 'https://example.com/pic.jpg'}
+        comments = [{'pk': str(i), 'text': str(i), 'user': user, 'created_at_utc': 1672531200,
+                     'content_type': 'comment', 'status': 'Active'} for i in range(2)]
+        client = self.Client([{'comments': comments, 'has_more_comments': True, 'next_max_id': 'next'},
+                              {'comments': comments, 'has_more_comments': False, 'next_max_id': 'last'}])
+        ig_tools = InstagramTools('user', 'password', rate_limiter=RateLimiter({'comments': 1000}), client=client)
+        media = types.SimpleNamespace(pk='1', id='1_2', comment_count=100)
+
+        file = io.StringIO()
+        ig_tools.write_media_comments(media, file, 10)
+        self.assertEqual(file.getvalue().count('user: '), 4)
+        self.assertEqual(client.params, [None, {'max_id': 'next'}])
+
+        cached = io.StringIO()
+        ig_tools.write_media_comments(media, cached, 10)
+        self.assertEqual(cached.getvalue(), file.getvalue())
+        self.assertEqual(len(client.params), 2)
+
+        client.params = []
+        limited = io.StringIO()
+        ig_tools.write_media_comments(media, limited, 3)
+        self.assertEqual(limited.getvalue().count('user: '), 3)
+
+
+class TestIteratePages(unittest.TestCase):
+    class Tools:
+        pages = {'': ([1, 2], 'a'), 'a': ([3], 'b'), 'b': ([], '')}
+        tagged_pages = {'': ([4], '')}
+
+        def get_user_medias_page(self, user_id, end_cursor=''):
+            return self.pages[end_cursor]
+
+        def get_user_tagged_medias_page(self, user_id, end_cursor=''):
+            return self.tagged_pages[end_cursor]
+
+    def test_iterate_pages(self):
+        async_tools = AsyncInstagramTools(self.Tools(), 1, 1, 1)
+
+        async def collect(pages):
+            return [item async for item in pages]
+
+        self.assertEqual(asyncio.run(collect(async_tools.iter_user_medias('user'))), [(1, ''), (2, ''), (3, 'a')])
+        self.assertEqual(asyncio.run(collect(async_tools.iter_user_medias('user', 'a'))), [(3, 'a')])
+        self.assertEqual(asyncio.run(collect(async_tools.iter_user_tagged_medias('user'))), [(4, '')])
+        async_tools.shutdown()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,33 +1,99 @@
 import configparser
+import secrets
 from pathlib import Path
 import logging
 from logging.handlers import RotatingFileHandler
-from instagramtools import InstagramTools
+from cache import PersistentLRUCache, MediaCache
+from instagramtools import InstagramTools, InstagramToolsPool, AsyncInstagramTools, BatchDownloader, RETRY_POLICY
+from jobqueue import JobQueue
+from jobstore import JobStore
+from metrics import METRICS, MetricsServer
+from ratelimiter import RateLimiter
+from subscriptions import SubscriptionStore, SubscriptionScheduler
 from telegramtools import TelegramTools
 
 
-def main(bot_tg_token, tg_admin_id, ig_username, ig_password) -> None:
-    ig_tools = InstagramTools(ig_username, ig_password)
-    TelegramTools(bot_tg_token, tg_admin_id, ig_tools)
+FILE_ID_CACHE_SIZE = 10000
+WATERMARKS_SIZE = 100000
+MEDIA_CACHE_SIZE_MB = 2048
+WORK_DIR = '/ext/work/'
+
+
+def main(config) -> None:
+    telegram, instagram = config['telegram'], config['instagram']
+    webhook = None
+    if telegram.get('mode', 'polling') == 'webhook':
+        webhook = {key: int(value) if key in ('port', 'max_connections') else value
+                   for key, value in (config['webhook'] if 'webhook' in config else {}).items() if value != ''}
+        if 'webhook_url' not in webhook or 'secret_token' not in webhook:
+            raise ValueError('webhook_url and secret_token are required in webhook mode')
+    media_cache = MediaCache('/ext/media_cache',
+                             instagram.getint('media_cache_size_mb', MEDIA_CACHE_SIZE_MB) * 1024 * 1024)
+    rate_limits = {key: float(value) for key, value in config['rate_limits'].items()} if 'rate_limits' in config else None
+    caches = InstagramTools.create_caches()
+    downloader = BatchDownloader(instagram.getint('download_parallelism', BatchDownloader.PARALLELISM))
+    sessions = []
+    for name in config.sections():
+        if name != 'instagram' and not name.startswith('instagram.'):
+            continue
+        account = config[name]
+        credential_file = account.get('settings', '/ext/credential.json' if name == 'instagram' else
+                                      '/ext/credential_{0}.json'.format(account['username']))
+        sessions.append(InstagramTools(account['username'], account['password'], media_cache,
+                                       RateLimiter(rate_limits), caches, credential_file, downloader))
+    pool = InstagramToolsPool(sessions)
+    ig_tools = AsyncInstagramTools(pool, instagram.getint('workers', AsyncInstagramTools.DEFAULT_WORKERS),
+                                   instagram.getint('feed_workers', AsyncInstagramTools.FEED_WORKERS),
+                                   instagram.getint('comment_workers', AsyncInstagramTools.COMMENT_WORKERS))
+    file_id_cache = PersistentLRUCache('/ext/file_ids.json', telegram.getint('file_id_cache_size', FILE_ID_CACHE_SIZE))
+    watermarks = PersistentLRUCache('/ext/watermarks.json', WATERMARKS_SIZE)
+    pipeline_limits = {key: int(value) for key, value in config['pipeline'].items()} if 'pipeline' in config else None
+    subscriptions = config['subscriptions'] if 'subscriptions' in config else {}
+    scheduler = SubscriptionScheduler(ig_tools, SubscriptionStore('/ext/subscriptions.json'),
+                                      int(subscriptions.get('poll_interval', SubscriptionScheduler.POLL_INTERVAL)),
+                                      int(subscriptions.get('max_calls_per_minute',
+                                                            SubscriptionScheduler.MAX_CALLS_PER_MINUTE)),
+                                      WORK_DIR + 'subscriptions/')
+    archive_compression = {extension: TelegramTools.SplitArchiver.COMPRESSION_TYPES[value]
+                           for extension, value in config['archive'].items()} if 'archive' in config else None
+    job_queue = JobQueue(JobStore('/ext/jobs.sqlite'),
+                         {key: int(value) for key, value in config['jobs'].items()} if 'jobs' in config else None)
+    metrics = config['metrics'] if 'metrics' in config else {}
+    if metrics.get('enabled', 'false') == 'true':
+        register_metrics(pool, ig_tools, job_queue, dict(caches, file_ids=file_id_cache, watermarks=watermarks,
+                                                         media=media_cache))
+        MetricsServer(METRICS, metrics.get('listen', MetricsServer.LISTEN),
+                      int(metrics.get('port', MetricsServer.PORT))).start()
+    TelegramTools(telegram['token'], telegram['admin'], ig_tools, file_id_cache, watermarks, scheduler, job_queue,
+                  pipeline_limits, archive_compression, webhook, metrics.get('trace_jobs', 'false') == 'true',
+                  WORK_DIR).run()
+
+
+def register_metrics(pool, ig_tools, job_queue, caches):
+    METRICS.add_stats('instasub_jobs', job_queue.stats)
+    METRICS.add_stats('instasub_instagram_executor', ig_tools.stats)
+    METRICS.add_stats('instasub_cache', lambda: {name: cache.stats() for name, cache in caches.items()}, 'cache')
+    METRICS.add_stats('instasub_instagram_retries', lambda: RETRY_POLICY.stats()['retries'], 'method')
+    METRICS.add_stats('instasub_instagram_retries', lambda: {'exhausted': RETRY_POLICY.stats()['exhausted']})
+    METRICS.add_stats('instasub_instagram_session', lambda: {session['username']: session for session in pool.stats()},
+                      'username')
+    METRICS.add_stats('instasub_rate_limit', lambda: {'{0}/{1}'.format(session['username'], endpoint): bucket
+                                                      for session in pool.stats()
+                                                      for endpoint, bucket in session['rate_limits'].items()}, 'bucket')
 
 
 def setup_logger():
     log_file = '/ext/instasub.log'
     log_formatter = logging.Formatter('%(asctime)s [%(process)s] {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s')
 
-    is_rotating_handler = RotatingFileHandler(log_file, maxBytes=64 * 1024 * 1024, mode='a', backupCount=1)
-    is_rotating_handler.setFormatter(log_formatter)
-    is_rotating_handler.setLevel(logging.INFO)
-
-    root_rotating_handler = RotatingFileHandler(log_file, maxBytes=64 * 1024 * 1024, mode='a', backupCount=1)
-    root_rotating_handler.setFormatter(log_formatter)
-    root_rotating_handler.setLevel(logging.WARNING)
+    rotating_handler = RotatingFileHandler(log_file, maxBytes=64 * 1024 * 1024, mode='a', backupCount=1)
+    rotating_handler.setFormatter(log_formatter)
+    rotating_handler.setLevel(logging.INFO)
 
-    logging.getLogger('root').setLevel(logging.WARNING)
-    logging.getLogger('root').addHandler(root_rotating_handler)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger().addHandler(rotating_handler)
 
     logging.getLogger('instasub').setLevel(logging.INFO)
-    logging.getLogger('instasub').addHandler(is_rotating_handler)
 
 
 if __name__ == "__main__":
@@ -37,9 +103,26 @@ if __name__ == "__main__":
         config_file = Path('/ext/instasub.ini')
         if not config_file.is_file():
             config = configparser.ConfigParser()
-            config['telegram'] = {'token': ''}
+            config['telegram'] = {'token': '',
+                                  'file_id_cache_size': str(FILE_ID_CACHE_SIZE),
+                                  'mode': 'polling'}
             config['instagram'] = {'username': '',
-                                   'password': ''}
+                                   'password': '',
+                                   'workers': str(AsyncInstagramTools.DEFAULT_WORKERS),
+                                   'feed_workers': str(AsyncInstagramTools.FEED_WORKERS),
+                                   'comment_workers': str(AsyncInstagramTools.COMMENT_WORKERS),
+                                   'download_parallelism': str(BatchDownloader.PARALLELISM),
+                                   'media_cache_size_mb': str(MEDIA_CACHE_SIZE_MB)}
+            config['webhook'] = dict({key: str(value) for key, value in TelegramTools.WEBHOOK.items()},
+                                     webhook_url='', secret_token=secrets.token_urlsafe(32))
+            config['metrics'] = {'enabled': 'false', 'listen': MetricsServer.LISTEN, 'port': str(MetricsServer.PORT),
+                                 'trace_jobs': 'false'}
+            config['pipeline'] = {key: str(value) for key, value in TelegramTools.PIPELINE_LIMITS.items()}
+            config['jobs'] = {key: str(value) for key, value in JobQueue.LIMITS.items()}
+            config['archive'] = {'.txt': 'deflated', '.jpg': 'stored', '.mp4': 'stored'}
+            config['rate_limits'] = {key: str(value) for key, value in RateLimiter.RATES.items()}
+            config['subscriptions'] = {'poll_interval': str(SubscriptionScheduler.POLL_INTERVAL),
+                                       'max_calls_per_minute': str(SubscriptionScheduler.MAX_CALLS_PER_MINUTE)}
             with open(config_file, 'w+') as configfile:
                 config.write(configfile)
 
@@ -51,11 +134,10 @@ if __name__ == "__main__":
                 'telegram'] and 'username' in config['instagram'] and 'password' in config['instagram'] and \
                     config['telegram']['token'] != '' and config['telegram']['admin'] != '' and config['instagram'][
                 'username'] != '' and config['instagram']['password'] != '':
-                logger.info('Start bot with arguments: TGToken - {0} TGAdmin - {1} IGUser - {2} IGPass - {3} '.format(
-                    config['telegram']['token'], config['telegram']['admin'], config['instagram']['username'],
-                    config['instagram']['password']))
-                main(config['telegram']['token'], config['telegram']['admin'], config['instagram']['username'],
-                     config['instagram']['password'])
+                logger.info('Start bot with arguments: TGBot - {0} TGAdmin - {1} IGUser - {2}'.format(
+                    config['telegram']['token'].split(':')[0], config['telegram']['admin'],
+                    config['instagram']['username']))
+                main(config)
             else:
                 logger.warning('Config file is incorrect:' + config_file.name)
     except Exception as e:
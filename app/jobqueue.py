@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import tempfile
+import unittest
+
+from telegram import Update
+
+from jobstore import Checkpoint, JobStore
+from metrics import CURRENT_TRACE, METRICS, Trace
+
+
+class Job:
+    def __init__(self, kind, target, user_id, heavy):
+        self.kind = kind
+        self.target = target
+        self.user_id = user_id
+        self.heavy = heavy
+        self.updates = []
+        self.running = False
+
+    @property
+    def key(self) -> tuple:
+        return self.kind, self.target
+
+    def to_dict(self) -> dict:
+        return {'kind': self.kind, 'target': self.target, 'user_id': self.user_id, 'heavy': self.heavy,
+                'updates': [update.to_dict() for update in self.updates]}
+
+
+class JobQueue:
+    LIMITS = {'per_user': 2, 'heavy': 2, 'total': 16}
+
+    def __init__(self, store, limits=None, on_error=None, on_trace=None):
+        self.logger = logging.getLogger('instasub')
+        self.store = store
+        self.on_error = on_error
+        self.on_trace = on_trace
+        self.limits = dict(self.LIMITS, **(limits or {}))
+        self.runners = {}
+        self.jobs = {}
+        self.pending = []
+        self.tasks = set()
+        self.served = {}
+        self.paused = False
+
+    def add_runner(self, kind, runner):
+        self.runners[kind] = runner
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._dispatch()
+
+    def checkpoint(self, job) -> Checkpoint:
+        return Checkpoint(self.store.load_checkpoint(job.key))
+
+    def save_checkpoint(self, job, checkpoint):
+        if job.key in self.jobs:
+            self.store.save_checkpoint(job.key, checkpoint.to_dict())
+
+    def restore(self, bot):
+        jobs = self.store.load_jobs()
+        for data in jobs:
+            job = Job(data['kind'], data['target'], data['user_id'], data['heavy'])
+            job.updates = [Update.de_json(update, bot) for update in data['updates']]
+            self.jobs[job.key] = job
+            self.pending.append(job)
+        self.logger.info('Restored {0} jobs'.format(len(jobs)))
+        self._dispatch()
+
+    def submit(self, kind, target, user_id, update, heavy=False) -> tuple:
+        job = self.jobs.get((kind, target))
+        merged = job is not None
+        if not merged:
+            job = Job(kind, target, user_id, heavy)
+            self.jobs[job.key] = job
+            self.pending.append(job)
+        job.updates.append(update)
+        self.store.save_job(job.key, job.to_dict())
+        self._dispatch()
+        return job, self.position(job), merged
+
+    def position(self, job) -> int:
+        return self.pending.index(job) + 1 if job in self.pending else 0
+
+    def running(self) -> list:
+        return [job for job in self.jobs.values() if job.running]
+
+    def _can_start(self, job, running) -> bool:
+        if len(running) >= self.limits['total']:
+            return False
+        if job.heavy and len([other for other in running if other.heavy]) >= self.limits['heavy']:
+            return False
+        return len([other for other in running if other.user_id == job.user_id]) < self.limits['per_user']
+
+    def _dispatch(self):
+        while not self.paused:
+            running = self.running()
+            eligible = [job for job in self.pending if self._can_start(job, running)]
+            if not eligible:
+                return
+            job = min(eligible, key=lambda job: (len([other for other in running if other.user_id == job.user_id]),
+                                                 self.served.get(job.user_id, 0)))
+            self.served[job.user_id] = self.served.get(job.user_id, 0) + 1
+            self.pending.remove(job)
+            job.running = True
+            task = asyncio.get_running_loop().create_task(self._run(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job):
+        interrupted = False
+        trace = Trace('{0} {1}'.format(job.kind, job.target))
+        CURRENT_TRACE.set(trace)
+        try:
+            with METRICS.timer('instasub_job_seconds', kind=job.kind):
+                await self.runners[job.kind](job)
+            if self.on_trace:
+                await self.on_trace(trace)
+        except asyncio.CancelledError:
+            self.logger.info('Job {0} interrupted, it will be resumed after restart'.format(job.key))
+            interrupted = True
+            raise
+        except Exception as e:
+            self.logger.error('Job {0} failed: {1}'.format(job.key, str(e)))
+            METRICS.inc('instasub_job_errors_total', kind=job.kind)
+            if self.on_error:
+                await self.on_error(e)
+        finally:
+            del self.jobs[job.key]
+            if not interrupted:
+                self.store.delete_job(job.key)
+                self._dispatch()
+
+    def stats(self) -> dict:
+        return {'pending': len(self.pending), 'running': len(self.running())}
+
+
+class TestJobQueue(unittest.TestCase):
+    def test_merge_and_limits(self):
+        async def run():
+            with tempfile.TemporaryDirectory() as temp_dir:
+                queue = JobQueue(JobStore(os.path.join(temp_dir, 'jobs.sqlite')),
+                                 {'per_user': 1, 'heavy': 1, 'total': 4})
+                release = asyncio.Event()
+                done = []
+
+                async def runner(job):
+                    await release.wait()
+                    done.append((job.target, len(job.updates)))
+
+                queue.add_runner('profile', runner)
+                self.assertEqual(queue.submit('profile', 'a', 1, Update(1), True)[1:], (0, False))
+                self.assertEqual(queue.submit('profile', 'a', 2, Update(2), True)[1:], (0, True))
+                self.assertEqual(queue.submit('profile', 'b', 1, Update(3), True)[1:], (1, False))
+                self.assertEqual(queue.submit('profile', 'c', 2, Update(4), True)[1:], (2, False))
+                release.set()
+                while queue.jobs:
+                    await asyncio.sleep(0)
+                self.assertEqual(done, [('a', 2), ('c', 1), ('b', 1)])
+
+        asyncio.run(run())
+
+    def test_pause(self):
+        async def run():
+            with tempfile.TemporaryDirectory() as temp_dir:
+                queue = JobQueue(JobStore(os.path.join(temp_dir, 'jobs.sqlite')))
+                done = []
+
+                async def runner(job):
+                    done.append(job.target)
+
+                queue.add_runner('media', runner)
+                queue.pause()
+                self.assertEqual(queue.submit('media', 'a', 1, Update(1))[1:], (1, False))
+                await asyncio.sleep(0)
+                self.assertEqual(done, [])
+                queue.resume()
+                while queue.jobs:
+                    await asyncio.sleep(0)
+                self.assertEqual(done, ['a'])
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
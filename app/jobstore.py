@@ -0,0 +1,122 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+
+class JobStore:
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.connection.commit()
+
+    @staticmethod
+    def _key(key) -> str:
+        return json.dumps(list(key))
+
+    def _save(self, table, key, data):
+        self.connection.execute('INSERT OR REPLACE INTO {0} (key, data) VALUES (?, ?)'.format(table),
+                                (self._key(key), json.dumps(data)))
+        self.connection.commit()
+
+    def _load(self, table, key):
+        row = self.connection.execute('SELECT data FROM {0} WHERE key = ?'.format(table), (self._key(key),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _delete(self, table, key):
+        self.connection.execute('DELETE FROM {0} WHERE key = ?'.format(table), (self._key(key),))
+        self.connection.commit()
+
+    def save_job(self, key, data):
+        self._save('jobs', key, data)
+
+    def delete_job(self, key):
+        self._delete('jobs', key)
+        self._delete('checkpoints', key)
+
+    def load_jobs(self) -> list:
+        return [json.loads(row[0]) for row in self.connection.execute('SELECT data FROM jobs ORDER BY rowid')]
+
+    def save_checkpoint(self, key, data):
+        self._save('checkpoints', key, data)
+
+    def load_checkpoint(self, key):
+        return self._load('checkpoints', key)
+
+
+class Checkpoint:
+    def __init__(self, data=None):
+        data = data or {}
+        self.marks = data.get('marks', {})
+        self.parts = data.get('parts', [])
+        self.delivered = data.get('delivered', {})
+        self.done = {section: set(pks) for section, pks in data.get('done', {}).items()}
+        self.pages = {section: [[cursor, set(pks)] for cursor, pks in pages]
+                      for section, pages in data.get('pages', {}).items()}
+        self.open_items = []
+
+    def to_dict(self) -> dict:
+        return {'marks': self.marks, 'parts': self.parts, 'delivered': self.delivered,
+                'done': {section: sorted(pks) for section, pks in self.done.items()},
+                'pages': {section: [[cursor, sorted(pks)] for cursor, pks in pages if pks]
+                          for section, pages in self.pages.items()}}
+
+    def cursor(self, section) -> str:
+        for cursor, pks in self.pages.get(section, []):
+            if pks:
+                return cursor
+        return ''
+
+    def is_done(self, section, pk) -> bool:
+        return str(pk) in self.done.get(section, set())
+
+    def listed(self, section, pk, cursor=''):
+        pages = self.pages.setdefault(section, [])
+        if not pages or pages[-1][0] != cursor:
+            pages.append([cursor, set()])
+        pages[-1][1].add(str(pk))
+
+    def archived(self, section, pk):
+        self.open_items.append((section, str(pk)))
+
+    def close_part(self) -> list:
+        items, self.open_items = self.open_items, []
+        return items
+
+    def part_delivered(self, file_id, items):
+        self.parts.append(file_id)
+        for section, pk in items:
+            self.done.setdefault(section, set()).add(pk)
+            for cursor, pks in self.pages.get(section, []):
+                pks.discard(pk)
+
+
+class TestJobStore(unittest.TestCase):
+    def test_checkpoint_roundtrip(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_name = os.path.join(temp_dir, 'jobs.sqlite')
+            store = JobStore(file_name)
+            checkpoint = Checkpoint()
+            checkpoint.listed('media', 1, '')
+            checkpoint.listed('media', 2, '')
+            checkpoint.listed('media', 3, 'page_2')
+            checkpoint.archived('media', 1)
+            checkpoint.archived('media', 2)
+            items = checkpoint.close_part()
+            checkpoint.archived('media', 3)
+            checkpoint.part_delivered('file_id', items)
+            store.save_checkpoint(('profile', 'user'), checkpoint.to_dict())
+
+            restored = Checkpoint(JobStore(file_name).load_checkpoint(('profile', 'user')))
+            self.assertEqual(restored.cursor('media'), 'page_2')
+            self.assertTrue(restored.is_done('media', 2))
+            self.assertFalse(restored.is_done('media', 3))
+            self.assertEqual(restored.parts, ['file_id'])
+            store.delete_job(('profile', 'user'))
+            self.assertIsNone(store.load_checkpoint(('profile', 'user')))
+
+
+if __name__ == '__main__':
+    unittest.main()
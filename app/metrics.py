@@ -0,0 +1,200 @@
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+import unittest
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.spans = {}
+
+    def add(self, name, seconds):
+        count, total = self.spans.get(name, (0, 0))
+        self.spans[name] = (count + 1, total + seconds)
+
+    def format(self) -> str:
+        lines = ['Job {0} took {1:.1f}s'.format(self.name, time.monotonic() - self.started)]
+        for name, (count, total) in sorted(self.spans.items(), key=lambda span: -span[1][1]):
+            lines.append('{0}: {1} calls, {2:.1f}s total, {3:.3f}s avg'.format(name, count, total, total / count))
+        return '\n'.join(lines)
+
+
+CURRENT_TRACE = contextvars.ContextVar('trace', default=None)
+STARTED = time.monotonic()
+
+
+class Metrics:
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    @staticmethod
+    def _key(name, labels) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [0] * len(self.BUCKETS) + [0, 0])
+            for i, bucket in enumerate(self.BUCKETS):
+                if value <= bucket:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, span=None, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            self.observe(name, elapsed, **labels)
+            trace = CURRENT_TRACE.get()
+            if trace is not None and span:
+                trace.add(span, elapsed)
+
+    def add_stats(self, prefix, stats, label=None):
+        self.collectors.append((prefix, stats, label))
+
+    def _collect(self) -> dict:
+        samples = {}
+        with self.lock:
+            for (name, labels), value in sorted(self.gauges.items()):
+                samples.setdefault(name, []).append((labels, float(value)))
+        for prefix, stats, label in self.collectors:
+            for key, value in stats().items():
+                if label is None:
+                    values = {'{0}_{1}'.format(prefix, key): ((), value)}
+                elif isinstance(value, dict):
+                    values = {'{0}_{1}'.format(prefix, name): (((label, key),), item) for name, item in value.items()}
+                else:
+                    values = {prefix: (((label, key),), value)}
+                for name, (labels, value) in values.items():
+                    if isinstance(value, (int, float)):
+                        samples.setdefault(name, []).append((labels, float(value)))
+        return samples
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('"', '\\"')) for name, value in labels) + '}'
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        for name, samples in sorted(self._collect().items()):
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.extend('{0}{1} {2}'.format(name, self._labels(labels), value) for labels, value in samples)
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0}{1} {2}'.format(name, self._labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+            for bucket, count in zip(self.BUCKETS, histogram):
+                lines.append('{0}_bucket{1} {2}'.format(name, self._labels(labels + (('le', bucket),)), count))
+            lines.append('{0}_bucket{1} {2}'.format(name, self._labels(labels + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('{0}_sum{1} {2}'.format(name, self._labels(labels), histogram[-2]))
+            lines.append('{0}_count{1} {2}'.format(name, self._labels(labels), histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class MetricsServer:
+    LISTEN = '127.0.0.1'
+    PORT = 9464
+
+    def __init__(self, metrics=METRICS, listen=LISTEN, port=PORT):
+        self.logger = logging.getLogger('instasub')
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics_server.logger.debug('Metrics request: ' + format % args)
+
+        self.server = ThreadingHTTPServer((listen, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.logger.info('Serving metrics on {0}:{1}/metrics'.format(*self.server.server_address))
+        self.thread.start()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render_and_serve(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', endpoint='feed')
+        metrics.inc('requests_total', 2, endpoint='feed')
+        metrics.observe('latency_seconds', 0.2, endpoint='feed')
+        metrics.add_stats('cache', lambda: {'user_info': {'hits': 3, 'misses': 1}}, 'cache')
+        metrics.add_stats('jobs', lambda: {'pending': 2})
+        metrics.set('startup_seconds', 1.5, stage='ready')
+        trace = Trace('job')
+        token = CURRENT_TRACE.set(trace)
+        with metrics.timer('latency_seconds', 'feed', endpoint='feed'):
+            pass
+        CURRENT_TRACE.reset(token)
+        self.assertEqual(trace.spans['feed'][0], 1)
+
+        server = MetricsServer(metrics, '127.0.0.1', 0)
+        server.start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{0}/metrics'.format(server.server.server_address[1])) as r:
+                text = r.read().decode()
+        finally:
+            server.shutdown()
+        self.assertIn('requests_total{endpoint="feed"} 3', text)
+        self.assertIn('latency_seconds_bucket{endpoint="feed",le="0.25"} 2', text)
+        self.assertIn('latency_seconds_count{endpoint="feed"} 2', text)
+        self.assertIn('cache_hits{cache="user_info"} 3.0', text)
+        self.assertIn('jobs_pending 2.0', text)
+        self.assertIn('startup_seconds{stage="ready"} 1.5', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
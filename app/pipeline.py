@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import unittest
+
+
+class Pipeline:
+    DEFAULT_OUTPUT_SIZE = 32
+
+    class Stage:
+        def __init__(self, name, handler, concurrency):
+            self.name = name
+            self.handler = handler
+            self.concurrency = concurrency
+            self.queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    __DONE = object()
+
+    def __init__(self, output_size=DEFAULT_OUTPUT_SIZE, on_error=None):
+        self.logger = logging.getLogger('instasub')
+        self.stages = []
+        self.sources = []
+        self.output = asyncio.Queue(maxsize=output_size)
+        self.on_error = on_error
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def add_stage(self, name, handler, concurrency):
+        self.stages.append(self.Stage(name, handler, concurrency))
+
+    async def emit(self, item):
+        await self.output.put(item)
+
+    async def _forward(self, index, item):
+        if index < len(self.stages):
+            await self.stages[index].queue.put(item)
+        else:
+            await self.emit(item)
+
+    async def _run_source(self, source):
+        async for item in source:
+            await self._forward(0, item)
+
+    async def _run_worker(self, index):
+        stage = self.stages[index]
+        while True:
+            item = await stage.queue.get()
+            if item is self.__DONE:
+                return
+            try:
+                async for next_item in stage.handler(item, self.emit):
+                    await self._forward(index + 1, next_item)
+            except Exception as e:
+                self.logger.error('Pipeline stage {0} failed on {1}: {2}'.format(stage.name, item, str(e)))
+                if self.on_error:
+                    await self.on_error(e, item)
+
+    async def _run_stage(self, index, producers):
+        await asyncio.gather(*producers)
+        if index < len(self.stages):
+            for i in range(self.stages[index].concurrency):
+                await self.stages[index].queue.put(self.__DONE)
+
+    async def _run(self):
+        tasks = [asyncio.create_task(self._run_source(source)) for source in self.sources]
+        stage_runs = [self._run_stage(0, tasks[:])]
+        for index, stage in enumerate(self.stages):
+            workers = [asyncio.create_task(self._run_worker(index)) for i in range(stage.concurrency)]
+            tasks.extend(workers)
+            stage_runs.append(self._run_stage(index + 1, workers))
+        try:
+            await asyncio.gather(*stage_runs)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def run(self):
+        runner = asyncio.create_task(self._run())
+        try:
+            while True:
+                getter = asyncio.create_task(self.output.get())
+                await asyncio.wait({getter, runner}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                    continue
+                getter.cancel()
+                while not self.output.empty():
+                    yield self.output.get_nowait()
+                runner.result()
+                break
+        finally:
+            runner.cancel()
+
+
+class TestPipeline(unittest.TestCase):
+    @staticmethod
+    def collect(pipeline):
+        async def run():
+            return [item async for item in pipeline.run()]
+
+        return asyncio.run(run())
+
+    @staticmethod
+    async def source(items):
+        for item in items:
+            yield item
+
+    def test_order_and_emit(self):
+        async def double(item, emit):
+            if item == 3:
+                await emit(('side', item))
+            yield item * 2
+
+        pipeline = Pipeline()
+        pipeline.add_source(self.source(range(10)))
+        pipeline.add_stage('double', double, 1)
+        pipeline.add_stage('same', lambda item, emit: self.source([item]), 1)
+        items = self.collect(pipeline)
+        self.assertEqual([item for item in items if not isinstance(item, tuple)], list(range(0, 20, 2)))
+        self.assertIn(('side', 3), items)
+
+    def test_concurrency_limit(self):
+        active = []
+        peak = []
+
+        async def slow(item, emit):
+            active.append(item)
+            peak.append(len(active))
+            await asyncio.sleep(0.01)
+            active.remove(item)
+            yield item
+
+        pipeline = Pipeline()
+        pipeline.add_source(self.source(range(8)))
+        pipeline.add_stage('slow', slow, 2)
+        self.assertEqual(sorted(self.collect(pipeline)), list(range(8)))
+        self.assertEqual(max(peak), 2)
+
+    def test_errors(self):
+        errors = []
+
+        async def on_error(e, item):
+            errors.append((str(e), item))
+
+        async def fail(item, emit):
+            if item == 2:
+                raise ValueError('item 2')
+            yield item
+
+        pipeline = Pipeline(on_error=on_error)
+        pipeline.add_source(self.source(range(4)))
+        pipeline.add_stage('fail', fail, 2)
+        self.assertEqual(sorted(self.collect(pipeline)), [0, 1, 3])
+        self.assertEqual(errors, [('item 2', 2)])
+
+        async def broken_source():
+            yield 1
+            raise ValueError('source')
+
+        pipeline = Pipeline()
+        pipeline.add_source(broken_source())
+        pipeline.add_stage('fail', fail, 1)
+        self.assertRaises(ValueError, self.collect, pipeline)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import logging
+import threading
+import time
+import unittest
+
+import requests
+from instagrapi.exceptions import (ClientThrottledError, FeedbackRequired,
+                                   PleaseWaitFewMinutes, RateLimitError)
+
+THROTTLE_EXCEPTIONS = (ClientThrottledError, FeedbackRequired, PleaseWaitFewMinutes, RateLimitError)
+
+
+def is_throttled(e) -> bool:
+    # CDN downloads fail with a plain requests.HTTPError
+    return isinstance(e, THROTTLE_EXCEPTIONS) or getattr(getattr(e, 'response', None), 'status_code', None) == 429
+
+
+class TokenBucket:
+    BACKOFF_FACTOR = 0.5
+    BACKOFF_PAUSE = 60
+    RECOVERY_STEP = 0.05
+    MIN_RATE_FACTOR = 0.05
+
+    def __init__(self, rate, capacity):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+        self.waited = 0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+                self.waited += delay
+            time.sleep(delay)
+
+    def backoff(self):
+        with self.lock:
+            self.rate = max(self.base_rate * self.MIN_RATE_FACTOR, self.rate * self.BACKOFF_FACTOR)
+            self.tokens = 0
+            self.paused_until = time.monotonic() + self.BACKOFF_PAUSE
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * self.RECOVERY_STEP)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'rate': self.rate, 'base_rate': self.base_rate, 'tokens': self.tokens, 'waited': self.waited}
+
+
+class RateLimiter:
+    RATES = {'info': 1.0, 'feed': 0.5, 'comments': 2.0, 'media': 5.0}
+    BURST = 5
+
+    def __init__(self, rates=None):
+        self.logger = logging.getLogger('instasub')
+        self.buckets = {endpoint: TokenBucket(rate, self.BURST)
+                        for endpoint, rate in dict(self.RATES, **(rates or {})).items()}
+
+    def call(self, endpoint, func, *args, **kwargs):
+        bucket = self.buckets[endpoint]
+        bucket.acquire()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if is_throttled(e):
+                self.logger.warning('Instagram throttled {0} requests, backing off'.format(endpoint))
+                bucket.backoff()
+            raise
+        bucket.recover()
+        return result
+
+    def stats(self) -> dict:
+        return {endpoint: bucket.stats() for endpoint, bucket in self.buckets.items()}
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_backoff_and_recover(self):
+        bucket = TokenBucket(10, 2)
+        bucket.acquire()
+        bucket.acquire()
+        bucket.BACKOFF_PAUSE = 0
+        bucket.backoff()
+        self.assertEqual(bucket.rate, 5)
+        bucket.recover()
+        self.assertEqual(bucket.rate, 5.5)
+        for i in range(20):
+            bucket.recover()
+        self.assertEqual(bucket.rate, 10)
+
+
+class TestRateLimiter(unittest.TestCase):
+    @staticmethod
+    def http_error(status_code):
+        response = requests.Response()
+        response.status_code = status_code
+        return requests.HTTPError(response=response)
+
+    def test_throttling_backs_off(self):
+        rate_limiter = RateLimiter({'media': 10})
+        rate_limiter.buckets['media'].BACKOFF_PAUSE = 0
+
+        def fail(e):
+            raise e
+
+        for e in (self.http_error(404), KeyError('pk')):
+            self.assertRaises(type(e), rate_limiter.call, 'media', fail, e)
+        self.assertEqual(rate_limiter.buckets['media'].rate, 10)
+        for e in (self.http_error(429), ClientThrottledError()):
+            self.assertRaises(type(e), rate_limiter.call, 'media', fail, e)
+        self.assertEqual(rate_limiter.buckets['media'].rate, 2.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import asyncio
+import atexit
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+
+class SubscriptionStore:
+    FLUSH_INTERVAL = 10
+
+    def __init__(self, file_name, flush_interval=FLUSH_INTERVAL):
+        self.file_name = file_name
+        self.accounts = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.dirty = False
+        if os.path.exists(file_name):
+            with open(file_name, encoding='utf-8') as store_file:
+                self.accounts = json.load(store_file)
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,),
+                                        name='subscriptions-flush', daemon=True)
+        self.flusher.start()
+        atexit.register(self.flush)
+
+    def _flush_periodically(self, interval):
+        while not self.closed.wait(interval):
+            self.flush()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = json.dumps(self.accounts)
+                self.dirty = False
+            temp_file = self.file_name + '.tmp'
+            with open(temp_file, 'w', encoding='utf-8') as store_file:
+                store_file.write(data)
+            os.replace(temp_file, self.file_name)
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+    def subscribe(self, user_id, username, chat_id) -> bool:
+        user_id = str(user_id)
+        with self.lock:
+            if user_id not in self.accounts:
+                now = time.time()
+                self.accounts[user_id] = {'username': username, 'chats': [], 'media_count': None,
+                                          'media': now, 'stories': now}
+            account = self.accounts[user_id]
+            if chat_id in account['chats']:
+                return False
+            account['chats'].append(chat_id)
+            self.dirty = True
+        return True
+
+    def unsubscribe(self, username, chat_id) -> bool:
+        with self.lock:
+            for user_id, account in list(self.accounts.items()):
+                if account['username'].lower() == username.lower() and chat_id in account['chats']:
+                    self._remove_chat(user_id, chat_id)
+                    self.dirty = True
+                    return True
+        return False
+
+    def unsubscribe_chat(self, chat_id):
+        with self.lock:
+            for user_id in list(self.accounts):
+                self._remove_chat(user_id, chat_id)
+            self.dirty = True
+
+    def _remove_chat(self, user_id, chat_id):
+        account = self.accounts[user_id]
+        if chat_id in account['chats']:
+            account['chats'].remove(chat_id)
+        if not account['chats']:
+            del self.accounts[user_id]
+
+    def chat_subscriptions(self, chat_id) -> list:
+        return sorted(account['username'] for account in self.accounts.values() if chat_id in account['chats'])
+
+    def update(self, user_id, **values):
+        with self.lock:
+            if user_id in self.accounts:
+                self.accounts[user_id].update(values)
+                self.dirty = True
+
+
+class SubscriptionScheduler:
+    POLL_INTERVAL = 30 * 60
+    MAX_CALLS_PER_MINUTE = 30
+    JITTER = 0.2
+    STORY_BATCH = 20
+    PINNED_LIMIT = 3
+    TICK = 10
+    WORK_DIR = '/ext/work/subscriptions/'
+
+    def __init__(self, ig_tools, store, poll_interval=POLL_INTERVAL, max_calls_per_minute=MAX_CALLS_PER_MINUTE,
+                 work_dir=WORK_DIR):
+        self.logger = logging.getLogger('instasub')
+        self.ig_tools = ig_tools
+        self.store = store
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.call_interval = 60 / max_calls_per_minute
+        self.next_call = 0
+        self.next_poll = {}
+
+    async def throttle(self):
+        now = time.monotonic()
+        self.next_call = max(self.next_call, now)
+        delay = self.next_call - now
+        self.next_call = self.next_call + self.call_interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def due_accounts(self) -> list:
+        now = time.monotonic()
+        return [user_id for user_id in self.store.accounts if self.next_poll.get(user_id, 0) <= now]
+
+    async def run(self, send):
+        while True:
+            due = self.due_accounts()
+            if not due:
+                await asyncio.sleep(self.TICK)
+                continue
+            for i in range(0, len(due), self.STORY_BATCH):
+                batch = due[i:i + self.STORY_BATCH]
+                try:
+                    await self.poll(batch, send)
+                except Exception as e:
+                    self.logger.error('Subscription poll failed for {0}: {1}'.format(batch, str(e)))
+                for user_id in batch:
+                    self.next_poll[user_id] = time.monotonic() + self.poll_interval * random.uniform(
+                        1 - self.JITTER, 1 + self.JITTER)
+
+    async def poll(self, batch, send):
+        await self.throttle()
+        reels = await self.ig_tools.get_reels(batch)
+        for user_id in batch:
+            if user_id not in self.store.accounts:
+                continue
+            work_dir = os.path.join(self.work_dir, user_id) + '/'
+            try:
+                await self.check_stories(user_id, reels.get(user_id, []), work_dir, send)
+                await self.check_medias(user_id, work_dir, send)
+            except Exception as e:
+                self.logger.error('Subscription check failed for {0}: {1}'.format(user_id, str(e)))
+            finally:
+                if os.path.exists(work_dir):
+                    shutil.rmtree(work_dir)
+
+    async def check_stories(self, user_id, stories, work_dir, send):
+        account = self.store.accounts[user_id]
+        new_stories = [story for story in stories if story.taken_at.timestamp() > account['stories']]
+        for story in sorted(new_stories, key=lambda story: story.taken_at):
+            await send(account['chats'], [await self.ig_tools.download_story(story, work_dir)], None)
+            self.store.update(user_id, stories=story.taken_at.timestamp())
+
+    async def check_medias(self, user_id, work_dir, send):
+        account = self.store.accounts[user_id]
+        await self.throttle()
+        media_count = await self.ig_tools.get_user_media_count(user_id)
+        if media_count == account['media_count']:
+            return
+        if account['media_count'] is None:
+            self.store.update(user_id, media_count=media_count)
+            return
+
+        await self.throttle()
+        new_medias = []
+        known = 0
+        async for media, end_cursor in self.ig_tools.iter_user_medias(user_id):
+            if media.taken_at.timestamp() > account['media']:
+                new_medias.append(media)
+            else:
+                known = known + 1
+                if known > self.PINNED_LIMIT:
+                    break
+
+        for media in sorted(new_medias, key=lambda media: media.taken_at):
+            await send(account['chats'], await self.ig_tools.download_media(media, work_dir),
+                       await self.ig_tools.get_media_info(media))
+            self.store.update(user_id, media=media.taken_at.timestamp())
+        self.store.update(user_id, media_count=media_count)
+
+
+class TestSubscriptionStore(unittest.TestCase):
+    def test_subscribe_and_unsubscribe(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SubscriptionStore(os.path.join(temp_dir, 'subscriptions.json'))
+            self.assertTrue(store.subscribe('1', 'username', 10))
+            self.assertFalse(store.subscribe('1', 'username', 10))
+            self.assertTrue(store.subscribe('1', 'username', 11))
+            self.assertEqual(store.chat_subscriptions(11), ['username'])
+            self.assertTrue(store.unsubscribe('UserName', 10))
+            self.assertFalse(store.unsubscribe('username', 10))
+            store.flush()
+            self.assertEqual(list(SubscriptionStore(store.file_name).accounts), ['1'])
+            store.update('1', media_count=5)
+            self.assertIsNone(SubscriptionStore(store.file_name).accounts['1']['media_count'])
+            store.unsubscribe_chat(11)
+            store.close()
+            self.assertEqual(SubscriptionStore(store.file_name).accounts, {})
+
+
+class TestSubscriptionScheduler(unittest.TestCase):
+    class Tools:
+        def __init__(self, medias):
+            self.medias = medias
+            self.media_count = 1
+            self.reels = []
+            self.listed = 0
+
+        async def get_reels(self, batch):
+            self.reels.append(batch)
+            return {user_id: [types.SimpleNamespace(pk='s' + user_id, taken_at=self.medias[0].taken_at)]
+                    for user_id in batch}
+
+        async def download_story(self, story, work_dir):
+            return story.pk
+
+        async def get_user_media_count(self, user_id):
+            return self.media_count
+
+        async def iter_user_medias(self, user_id):
+            for media in self.medias:
+                self.listed = self.listed + 1
+                yield media, ''
+
+        async def download_media(self, media, work_dir):
+            return [media.pk]
+
+        async def get_media_info(self, media):
+            return 'info'
+
+    def test_poll(self):
+        now = datetime.datetime.now()
+        medias = [types.SimpleNamespace(pk='m' + str(i), taken_at=now + datetime.timedelta(seconds=10 - i * 10))
+                  for i in range(10)]
+        tools = self.Tools(medias)
+        sent = []
+
+        async def send(chat_ids, paths, caption):
+            sent.append((list(chat_ids), paths))
+
+        async def run():
+            with tempfile.TemporaryDirectory() as temp_dir:
+                store = SubscriptionStore(os.path.join(temp_dir, 'subscriptions.json'))
+                store.subscribe('1', 'first', 10)
+                store.subscribe('2', 'second', 20)
+                scheduler = SubscriptionScheduler(tools, store, max_calls_per_minute=60000,
+                                                  work_dir=os.path.join(temp_dir, 'work/'))
+                scheduler.STORY_BATCH = 1
+                poller = asyncio.create_task(scheduler.run(send))
+                while len(tools.reels) < 2:
+                    await asyncio.sleep(0.01)
+                self.assertEqual(tools.reels, [['1'], ['2']])
+                self.assertEqual(sent, [([10], ['s1']), ([20], ['s2'])])
+
+                tools.media_count = 2
+                await scheduler.poll(['1'], send)
+                poller.cancel()
+                self.assertEqual(sent[2:], [([10], ['m0'])])
+                self.assertEqual(tools.listed, 2 + SubscriptionScheduler.PINNED_LIMIT)
+                await scheduler.poll(['1'], send)
+                self.assertEqual(len(sent), 3)
+                store.close()
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
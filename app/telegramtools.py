@@ -1,21 +1,43 @@
+import asyncio
+import contextlib
+import datetime
+import functools
 import html
+import io
 import json
 import logging
 import os
+import re
 import shutil
+import socket
+import tempfile
+import threading
 import traceback
+import types
+import unittest
+import urllib.error
+import urllib.request
 import zipfile
-from time import sleep
+from collections import namedtuple
+from time import monotonic, sleep
+from unittest import mock
 
-from aiostream import stream
 from telegram import Update, InputMediaPhoto, InputMediaVideo
 from telegram.constants import ParseMode
-from telegram.error import (TimedOut, TelegramError)
+from telegram.error import (Forbidden, RetryAfter, TimedOut, TelegramError)
 from telegram.ext import (Application, CommandHandler, ContextTypes, filters,
                           MessageHandler)
+from telegram.request import BaseRequest
 
-from instagramtools import (PrivateAccountException, UserNotFound,
+from cache import PersistentLRUCache
+from instagramtools import (InstagramTools, PrivateAccountException, UserNotFound,
                             MediaNotFound, HighlightNotFound)
+from jobqueue import Job, JobQueue
+from jobstore import Checkpoint, JobStore
+from metrics import METRICS, STARTED
+from pipeline import Pipeline
+
+ArchivedItem = namedtuple('ArchivedItem', 'section pk')
 
 
 async def timeout_retry(attempts, func, *args, **kwargs):
@@ -24,6 +46,11 @@ async def timeout_retry(attempts, func, *args, **kwargs):
             result = await func(*args, **kwargs)
         except TimedOut as err:
             exception = err
+        except RetryAfter as err:
+            exception = err
+            METRICS.inc('instasub_telegram_flood_waits_total')
+            if i + 1 < attempts:
+                await asyncio.sleep(err.retry_after)
         except Exception as err:
             raise err
         else:
@@ -33,28 +60,150 @@ async def timeout_retry(attempts, func, *args, **kwargs):
 
 class TelegramTools:
     FILE_SIZE_LIMIT = 48 * 1024 * 1024
+    PIPELINE_LIMITS = {'metadata': 4, 'comments': 4, 'download': 4, 'output': Pipeline.DEFAULT_OUTPUT_SIZE,
+                       'uploads': 2, 'comment_limit': InstagramTools.COMMENT_LIMIT, 'progress_interval': 5}
+    PINNED_LIMIT = 3
+    HEAVY_JOBS = ('profile', 'new')
+    HIGHLIGHT_BATCH = InstagramTools.HIGHLIGHT_BATCH
+    WEBHOOK = {'listen': '0.0.0.0', 'port': 8443, 'url_path': 'telegram', 'max_connections': 40}
+    LOGIN_RETRY = 5 * 60
+    WORK_DIR = '/ext/work/'
+    RESTART_DELAY = 1
+    RESTART_DELAY_MAX = 5 * 60
+    ADMIN_NOTIFY_INTERVAL = 10 * 60
+    CAPTION_LIMIT = 1024
+    USERNAME = re.compile(r'^@?[A-Za-z0-9._]{1,30}$')
+    PUNCTUATION = '.,;:!?()[]{}<>"\'«»'
 
-    def __init__(self, bot_token, admin_id, ig_tools):
+    def __init__(self, bot_token, admin_id, ig_tools, file_id_cache, watermarks, scheduler, job_queue,
+                 pipeline_limits=None, archive_compression=None, webhook=None, trace_jobs=False, work_dir=WORK_DIR):
         self.logger = logging.getLogger('instasub')
+        self.work_dir = work_dir
         self.ig_tools = ig_tools
+        self.file_id_cache = file_id_cache
+        self.watermarks = watermarks
+        self.scheduler = scheduler
+        self.job_queue = job_queue
+        self.job_queue.on_error = self.job_error
+        if trace_jobs:
+            self.job_queue.on_trace = self.job_trace
+        for kind in ('story', 'media', 'highlight', 'batch'):
+            self.job_queue.add_runner(kind, self.run_single_job)
+        for kind in self.HEAVY_JOBS:
+            self.job_queue.add_runner(kind, self.run_profile_job)
+        self.pipeline_limits = dict(self.PIPELINE_LIMITS, **(pipeline_limits or {}))
+        self.archive_compression = archive_compression
         self.admin_id = admin_id
-        self.logger.info('Sign in to telegram bot: id - {0}'.format(bot_token))
-        self.application = Application.builder().token(bot_token).concurrent_updates(True).build()
-        self.application.add_handler(CommandHandler('start', self.help_command))
-        self.application.add_handler(CommandHandler('help', self.help_command))
-        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.resolve_command))
+        self.replied = False
+        # max_connections is the limit Telegram applies to the webhook, updates are processed with the same bound
+        self.webhook = dict(self.WEBHOOK, **webhook) if webhook is not None else None
+        self.logger.info('Sign in to telegram bot: id - {0}'.format(bot_token.split(':')[0]))
+        self.application = self.application_builder().token(bot_token).concurrent_updates(
+            self.webhook['max_connections'] if self.webhook is not None else True).post_init(
+            self.post_init).post_shutdown(self.post_shutdown).build()
+        self.application.add_handler(CommandHandler('start', self.instrument(self.help_command)))
+        self.application.add_handler(CommandHandler('help', self.instrument(self.help_command)))
+        self.application.add_handler(CommandHandler('new', self.instrument(self.download_new_medias)))
+        self.application.add_handler(CommandHandler('subscribe', self.instrument(self.subscribe_command)))
+        self.application.add_handler(CommandHandler('unsubscribe', self.instrument(self.unsubscribe_command)))
+        self.application.add_handler(CommandHandler('subscriptions', self.instrument(self.subscriptions_command)))
+        self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND,
+                                                    self.instrument(self.resolve_command)))
         self.application.add_error_handler(self.error_handler)
 
+    @staticmethod
+    def application_builder():
+        return Application.builder()
+
+    def run(self):
+        if self.webhook is not None:
+            self.logger.info('Listening for webhook updates on {0}:{1}/{2}'.format(
+                self.webhook['listen'], self.webhook['port'], self.webhook['url_path']))
+        delay = self.RESTART_DELAY
+        notified = None
         while True:
+            # run_polling and run_webhook close their event loop when they return
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            started = monotonic()
             try:
-                self.application.run_polling()
+                if self.webhook is not None:
+                    self.application.run_webhook(**self.webhook)
+                else:
+                    self.application.run_polling()
+                return
             except TelegramError as e:
-                self.logger.error('Telegram error occurred:', e.message)
-                self.notify_admin(e.message)
+                message = e.message
+                self.logger.error('Telegram error occurred: {0}'.format(message))
+            except Exception as e:
+                message = str(e)
+                self.logger.error('Exception occurred: {0}'.format(message))
+            if notified is None or monotonic() - notified >= self.ADMIN_NOTIFY_INTERVAL:
+                notified = monotonic()
+                self.notify_admin_outside_loop(message)
+            if monotonic() - started >= self.RESTART_DELAY_MAX:
+                delay = self.RESTART_DELAY
+            self.logger.info('Restarting the bot in {0} s'.format(delay))
+            sleep(delay)
+            delay = min(delay * 2, self.RESTART_DELAY_MAX)
+
+    def notify_admin_outside_loop(self, message):
+        async def notify():
+            async with self.application.bot:
+                await self.notify_admin(message)
+
+        try:
+            asyncio.run(notify())
+        except Exception as e:
+            self.logger.error('Failed to notify admin: {0}'.format(str(e)))
+
+    async def post_init(self, application: Application) -> None:
+        METRICS.set('instasub_startup_seconds', monotonic() - STARTED, stage='telegram')
+        self.reclaim_work_dirs()
+        self.job_queue.pause()
+        self.job_queue.restore(application.bot)
+        application.create_task(self.warm_up())
+
+    async def post_shutdown(self, application: Application) -> None:
+        self.file_id_cache.flush()
+        self.watermarks.flush()
+        self.scheduler.store.flush()
+
+    async def warm_up(self):
+        while True:
+            try:
+                await self.ig_tools.start()
+                break
             except Exception as e:
-                self.logger.error('Exception occurred:', e)
-                self.notify_admin(str(e))
-            sleep(1)
+                self.logger.error('Instagram sign in failed: {0}'.format(str(e)))
+                await self.notify_admin('Instagram sign in failed: ' + str(e))
+                await asyncio.sleep(self.LOGIN_RETRY)
+        METRICS.set('instasub_startup_seconds', monotonic() - STARTED, stage='instagram')
+        self.job_queue.resume()
+        await self.scheduler.run(self.send_to_subscribers)
+
+    def instrument(self, handler):
+        @functools.wraps(handler)
+        async def wrapped_func(update, context):
+            METRICS.inc('instasub_telegram_updates_total', handler=handler.__name__)
+            with METRICS.timer('instasub_telegram_handler_seconds', handler=handler.__name__):
+                result = await handler(update, context)
+            if not self.replied:
+                self.replied = True
+                METRICS.set('instasub_startup_seconds', monotonic() - STARTED, stage='first_reply')
+            return result
+
+        return wrapped_func
+
+    def work_path(self, update: Update) -> str:
+        return os.path.join(self.work_dir, str(update.update_id)) + '/'
+
+    def reclaim_work_dirs(self):
+        # only request and subscription downloads live in the work dir, anything left there is from the last run
+        if not os.path.isdir(self.work_dir):
+            return
+        for name in os.listdir(self.work_dir):
+            self.logger.info('Removing orphaned work dir {0}'.format(name))
+            shutil.rmtree(os.path.join(self.work_dir, name), ignore_errors=True)
 
     async def error_handler(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
         self.logger.error(msg='Exception while handling an update:', exc_info=context.error)
@@ -77,39 +226,202 @@ class TelegramTools:
         )
 
     async def notify_admin(self, message):
-        self.application.bot.send_message(self.admin_id, message)
+        await self.application.bot.send_message(self.admin_id, message)
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await timeout_retry(3, update.message.reply_text,
-                            'Send me an username and I will send you an archived profile! Also you can send me a link to a story, post or highlight!')
+                            'Send me an username and I will send you an archived profile! Also you can send me a link to a story, post or highlight!\n'
+                            'You can also send several links or usernames in one message.\n'
+                            'Use /new <username> to get only the posts published since your last archive of that '
+                            'account.\n'
+                            'Use /subscribe <username> to get new posts and stories of an account as they appear, '
+                            '/unsubscribe <username> to stop and /subscriptions to list your subscriptions.')
+
+    @classmethod
+    def parse_targets(cls, text) -> list:
+        targets = []
+        # plain words are usernames only in a list of single words, otherwise they are more likely commentary
+        bare_usernames = all(len(entry.split()) <= 1 for entry in re.split(r'[\n,;]', text))
+        for word in text.split():
+            word = word.strip(cls.PUNCTUATION).split('?')[0]
+            if '/highlights/' in word:
+                target = 'highlight', word
+            elif '/stories/' in word:
+                target = 'story', word
+            elif '/p/' in word or '/reel/' in word:
+                target = 'media', word
+            else:
+                try:
+                    username = InstagramTools.extract_username(word)
+                except UserNotFound:
+                    continue
+                if not cls.USERNAME.match(username) or not (
+                        bare_usernames or 'instagram.com/' in word or word.startswith('@')):
+                    continue
+                target = 'profile', username.lstrip('@').lower()
+            if target not in targets:
+                targets.append(target)
+        return targets
 
     async def resolve_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         self.logger.info('New request from {0}: {1}'.format(update.message.from_user.id, update.message.text))
-        if '/highlights/' in update.message.text:
-            return await self.download_highlight(update, context)
-        elif '/stories/' in update.message.text:
-            return await self.download_story(update, context)
-        elif '/p/' in update.message.text or '/reel/' in update.message.text:
-            return await self.download_media(update, context)
-        else:
+        targets = self.parse_targets(update.message.text)
+        if not targets:
+            return await self.reply_unrecognized(update)
+        links = [target for kind, target in targets if kind != 'profile']
+        if len(links) > 1:
+            await self.enqueue('batch', ' '.join(links), update)
+        for kind, target in targets:
+            if kind == 'profile' or len(links) == 1:
+                await self.enqueue(kind, target, update)
+
+    async def reply_unrecognized(self, update: Update) -> None:
+        self.logger.warning(
+            'Unrecognized request from {0}: {1}'.format(update.message.from_user.id, update.message.text))
+        await timeout_retry(3, update.message.reply_text, 'I don\'t know what to do with that. Try something else')
+
+    async def enqueue(self, kind, target, update: Update) -> None:
+        job, position, merged = self.job_queue.submit(kind, target, update.message.from_user.id, update,
+                                                      kind in self.HEAVY_JOBS)
+        if merged:
+            await timeout_retry(3, update.message.reply_text,
+                                'The same request is already in progress, you will get its result when it is ready')
+        elif position:
+            await timeout_retry(3, update.message.reply_text,
+                                'Your request is queued, position in queue: {0}'.format(position))
+
+    async def job_error(self, e):
+        await self.notify_admin('During job processing exception occurred: ' + str(e))
+
+    async def job_trace(self, trace):
+        await self.notify_admin(trace.format())
+
+    async def run_single_job(self, job):
+        handler = {'story': self.download_story, 'media': self.download_media,
+                   'highlight': self.download_highlight, 'batch': self.download_batch}[job.kind]
+        i = 0
+        while i < len(job.updates):
+            try:
+                await handler(job.updates[i], None, job.target)
+            except Exception as e:
+                self.logger.error('Job {0} failed for {1}: {2}'.format(job.key, job.updates[i].update_id, str(e)))
+                await self.job_error(e)
+            i = i + 1
+
+    async def run_profile_job(self, job):
+        username = job.target.split(':')[-1]
+        try:
+            status = await self.download_profile(job.updates[0], None, username, job.kind == 'new', job)
+        except Exception:
+            for update in job.updates:
+                await timeout_retry(3, update.message.reply_text, 'Account download failed')
+            raise
+        # the first requester sees the status in its progress message
+        for update in job.updates[1:]:
+            await timeout_retry(3, update.message.reply_text, status)
+
+    @staticmethod
+    def media_kind(path) -> str:
+        return 'video' if str(path).endswith('.mp4') else 'photo'
+
+    @staticmethod
+    def message_file_id(message) -> list:
+        if message.video:
+            return ['video', message.video.file_id]
+        return ['photo', message.photo[-1].file_id]
+
+    async def send_media(self, send_media_group, items, captions=None) -> list:
+        captions = captions or [None] * len(items)
+        file_ids = []
+        for i in range(0, len(items), 10):
+            medias = [InputMediaVideo(media=media, caption=caption) if kind == 'video' else
+                      InputMediaPhoto(media=media, caption=caption)
+                      for (kind, media), caption in zip(items[i:i + 10], captions[i:i + 10])]
+            with METRICS.timer('instasub_telegram_upload_seconds', 'upload', kind='media_group'):
+                messages = await timeout_retry(3, send_media_group, medias)
+            METRICS.inc('instasub_uploaded_files_total', len(medias), kind='media')
+            file_ids.extend(self.message_file_id(message) for message in messages)
+        return file_ids
+
+    async def reply_media(self, update: Update, items, captions=None) -> list:
+        return await self.send_media(update.message.reply_media_group, items, captions)
+
+    async def send_to_subscribers(self, chat_ids, paths, caption):
+        file_ids = None
+        for chat_id in list(chat_ids):
+            send_media_group = functools.partial(self.application.bot.send_media_group, chat_id)
             try:
-                return await self.download_profile(update, context)
-            except UserNotFound:
-                self.logger.warning(
-                    'Unrecognized request from {0}: {1}'.format(update.message.from_user.id, update.message.text))
-                await timeout_retry(3, update.message.reply_text,
-                                    'I don\'t know what to do with that. Try something else')
-
-    async def download_story(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+                if file_ids is None:
+                    with contextlib.ExitStack() as stack:
+                        items = [(self.media_kind(path), stack.enter_context(open(path, 'rb'))) for path in paths]
+                        file_ids = await self.send_media(send_media_group, items)
+                else:
+                    await self.send_media(send_media_group, file_ids)
+                if caption:
+                    await timeout_retry(3, self.application.bot.send_message, chat_id, caption)
+            except Forbidden:
+                self.logger.info('Chat {0} blocked the bot, removing its subscriptions'.format(chat_id))
+                self.scheduler.store.unsubscribe_chat(chat_id)
+            except Exception as e:
+                self.logger.error('Failed to send subscription update to {0}: {1}'.format(chat_id, str(e)))
+
+    async def subscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if len(context.args) != 1:
+            await timeout_retry(3, update.message.reply_text, 'Usage: /subscribe <username>')
+            return
+        try:
+            user_id = await self.ig_tools.get_user_id(context.args[0])
+            if not await self.ig_tools.is_public_account(user_id):
+                await timeout_retry(3, update.message.reply_text, 'The account is private')
+                return
+        except UserNotFound:
+            await timeout_retry(3, update.message.reply_text, 'Invalid link or username')
+            return
+        username = InstagramTools.extract_username(context.args[0])
+        if self.scheduler.store.subscribe(user_id, username, update.message.chat_id):
+            self.logger.info('Chat {0} subscribed to {1}'.format(update.message.chat_id, username))
+            await timeout_retry(3, update.message.reply_text,
+                                'You will get new posts and stories of {0}'.format(username))
+        else:
+            await timeout_retry(3, update.message.reply_text, 'You are already subscribed to {0}'.format(username))
+
+    async def unsubscribe_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if len(context.args) != 1:
+            await timeout_retry(3, update.message.reply_text, 'Usage: /unsubscribe <username>')
+            return
+        username = InstagramTools.extract_username(context.args[0])
+        if self.scheduler.store.unsubscribe(username, update.message.chat_id):
+            self.logger.info('Chat {0} unsubscribed from {1}'.format(update.message.chat_id, username))
+            await timeout_retry(3, update.message.reply_text, 'You are unsubscribed from {0}'.format(username))
+        else:
+            await timeout_retry(3, update.message.reply_text, 'You are not subscribed to {0}'.format(username))
+
+    async def subscriptions_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        usernames = self.scheduler.store.chat_subscriptions(update.message.chat_id)
+        if usernames:
+            await timeout_retry(3, update.message.reply_text, 'Your subscriptions:\n' + '\n'.join(usernames))
+        else:
+            await timeout_retry(3, update.message.reply_text, 'You have no subscriptions')
+
+    async def download_story(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url=None) -> None:
+        url = url or update.message.text
         try:
             reply_message = await timeout_retry(3, update.message.reply_text, 'Downloading story...')
-            download_path = str(update.update_id) + '/'
-            story_path = self.ig_tools.download_story_from_url(update.message.text, download_path)
+            download_path = self.work_path(update)
+            cache_key = 'story:' + str(await self.ig_tools.get_story_pk(url))
+            cached = self.file_id_cache.get(cache_key)
+            if cached:
+                kind, story = cached['items'][0]
+            else:
+                story_path = await self.ig_tools.download_story_from_url(url, download_path)
+                kind, story = self.media_kind(story_path), open(story_path, 'rb')
             await timeout_retry(3, reply_message.edit_text, 'Here is your story')
-            if str(story_path).endswith('.mp4'):
-                await timeout_retry(3, update.message.reply_video, open(story_path, 'rb'))
+            if kind == 'video':
+                message = await timeout_retry(3, update.message.reply_video, story)
             else:
-                await timeout_retry(3, update.message.reply_photo, open(story_path, 'rb'))
+                message = await timeout_retry(3, update.message.reply_photo, story)
+            if not cached:
+                self.file_id_cache.set(cache_key, {'items': [self.message_file_id(message)]})
 
             if os.path.exists(download_path):
                 shutil.rmtree(download_path)
@@ -123,25 +435,23 @@ class TelegramTools:
                                                                                          update.message.text))
             await timeout_retry(3, reply_message.edit_text, 'Story not found')
 
-    async def download_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    async def download_media(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url=None) -> None:
+        url = url or update.message.text
         try:
             reply_message = await timeout_retry(3, update.message.reply_text, 'Downloading media...')
-            download_path = str(update.update_id) + '/'
-            media_paths = self.ig_tools.download_media_from_url(update.message.text, download_path)
-            medias = []
-            for media_path in media_paths:
-                if str(media_path).endswith('.mp4'):
-                    medias.append(InputMediaVideo(media=open(media_path, 'rb')))
-                else:
-                    medias.append(InputMediaPhoto(media=open(media_path, 'rb')))
+            download_path = self.work_path(update)
+            cache_key = 'media:' + str(await self.ig_tools.get_media_pk(url))
+            cached = self.file_id_cache.get(cache_key)
+            if cached:
+                medias, caption = cached['items'], cached['caption']
+            else:
+                media_paths, caption = await self.ig_tools.download_media_from_url(url, download_path)
+                medias = [(self.media_kind(media_path), open(media_path, 'rb')) for media_path in media_paths]
             await timeout_retry(3, reply_message.edit_text, 'Here is your media')
-            caption = self.ig_tools.get_media_info_from_url(update.message.text)
-            # if len(caption) > 1024:
-            if True:
-                await timeout_retry(3, update.message.reply_media_group, medias)
-                await timeout_retry(3, update.message.reply_text, caption)
-            # else:
-            #    await timeout_retry(3, update.message.reply_media_group, media=medias, caption=caption)
+            file_ids = await self.reply_media(update, medias)
+            await timeout_retry(3, update.message.reply_text, caption)
+            if not cached:
+                self.file_id_cache.set(cache_key, {'items': file_ids, 'caption': caption})
 
             if os.path.exists(download_path):
                 shutil.rmtree(download_path)
@@ -155,28 +465,23 @@ class TelegramTools:
                                                                                          update.message.text))
             await timeout_retry(3, reply_message.edit_text, 'Media not found')
 
-    async def download_highlight(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    async def download_highlight(self, update: Update, context: ContextTypes.DEFAULT_TYPE, url=None) -> None:
+        url = url or update.message.text
         try:
             reply_message = await timeout_retry(3, update.message.reply_text, 'Downloading highlight...')
-            download_path = str(update.update_id) + '/'
-            highlight_paths = self.ig_tools.download_highlights_from_url(update.message.text, download_path)
+            download_path = self.work_path(update)
+            cache_key = 'highlight:' + str(await self.ig_tools.get_highlight_pk(url))
+            cached = self.file_id_cache.get(cache_key)
+            if cached:
+                highlights = cached['items']
+            else:
+                highlight_paths = await self.ig_tools.download_highlights_from_url(url, download_path)
+                highlights = [(self.media_kind(highlight_path), open(highlight_path, 'rb'))
+                              for highlight_path in highlight_paths]
             await timeout_retry(3, reply_message.edit_text, 'Here is your highlights')
-            highlights = []
-            highlight_counter = 0
-            highlight_index = 0
-            for highlight_path in highlight_paths:
-                if str(highlight_path).endswith('.mp4'):
-                    highlights.append(InputMediaVideo(media=open(highlight_path, 'rb')))
-                else:
-                    highlights.append(InputMediaPhoto(media=open(highlight_path, 'rb')))
-
-                highlight_counter = highlight_counter + 1
-                highlight_index = highlight_index + 1
-
-                if highlight_counter == 10 or highlight_index == len(highlight_paths):
-                    await timeout_retry(3, update.message.reply_media_group, highlights)
-                    highlights = []
-                    highlight_counter = 0
+            file_ids = await self.reply_media(update, highlights)
+            if not cached:
+                self.file_id_cache.set(cache_key, {'items': file_ids})
 
             if os.path.exists(download_path):
                 shutil.rmtree(download_path)
@@ -191,154 +496,873 @@ class TelegramTools:
                     update.message.text))
             await timeout_retry(3, reply_message.edit_text, 'Highlight not found')
 
+    async def batch_key(self, kind, url) -> str:
+        get_pk = {'story': self.ig_tools.get_story_pk, 'media': self.ig_tools.get_media_pk,
+                  'highlight': self.ig_tools.get_highlight_pk}[kind]
+        return '{0}:{1}'.format(kind, await get_pk(url))
+
+    async def fetch_batch_item(self, kind, url, cache_key, path, semaphore) -> tuple:
+        cached = self.file_id_cache.get(cache_key)
+        if cached:
+            return cached['items'], cached.get('caption', ''), True
+        async with semaphore:
+            if kind == 'media':
+                paths, caption = await self.ig_tools.download_media_from_url(url, path)
+            elif kind == 'story':
+                paths, caption = [await self.ig_tools.download_story_from_url(url, path)], ''
+            else:
+                paths, caption = await self.ig_tools.download_highlights_from_url(url, path), ''
+        return [(self.media_kind(media_path), media_path) for media_path in paths], caption, False
+
+    async def download_batch(self, update: Update, context: ContextTypes.DEFAULT_TYPE, targets=None) -> None:
+        targets = self.parse_targets(targets or update.message.text)
+        reply_message = await timeout_retry(3, update.message.reply_text,
+                                            'Downloading {0} links...'.format(len(targets)))
+        download_path = self.work_path(update)
+        keys = await asyncio.gather(*(self.batch_key(kind, url) for kind, url in targets), return_exceptions=True)
+        not_found = [url for (kind, url), key in zip(targets, keys) if isinstance(key, Exception)]
+        unique = {}
+        for (kind, url), key in zip(targets, keys):
+            if not isinstance(key, Exception):
+                unique.setdefault(key, (kind, url))
+        semaphore = asyncio.Semaphore(self.pipeline_limits['download'])
+        items, captions, sent = [], [], []
+        try:
+            results = await asyncio.gather(
+                *(self.fetch_batch_item(kind, url, key, download_path + str(i) + '/', semaphore)
+                  for i, (key, (kind, url)) in enumerate(unique.items())), return_exceptions=True)
+            for (key, (kind, url)), result in zip(unique.items(), results):
+                if isinstance(result, (MediaNotFound, HighlightNotFound, UserNotFound, PrivateAccountException)):
+                    not_found.append(url)
+                    continue
+                if isinstance(result, Exception):
+                    self.logger.error('Batch item {0} failed: {1}'.format(url, str(result)))
+                    not_found.append(url)
+                    continue
+                medias, caption, cached = result
+                sent.append((key, len(items), len(medias), caption, cached))
+                captions.extend([caption[:self.CAPTION_LIMIT] or None] + [None] * (len(medias) - 1))
+                items.extend((kind, media, not cached) for kind, media in medias)
+
+            if items:
+                await timeout_retry(3, reply_message.edit_text, 'Here is your media')
+                file_ids = []
+                for i in range(0, len(items), 10):
+                    # open only the files of the group being sent
+                    with contextlib.ExitStack() as stack:
+                        group = [(kind, stack.enter_context(open(media, 'rb')) if downloaded else media)
+                                 for kind, media, downloaded in items[i:i + 10]]
+                        file_ids.extend(await self.reply_media(update, group, captions[i:i + 10]))
+                for key, start, count, caption, cached in sent:
+                    if not cached:
+                        self.file_id_cache.set(key, {'items': file_ids[start:start + count], 'caption': caption})
+        finally:
+            if os.path.exists(download_path):
+                shutil.rmtree(download_path)
+
+        summary = 'Sent {0} of {1} links in {2} messages'.format(len(targets) - len(not_found), len(targets),
+                                                                 (len(items) + 9) // 10)
+        if not_found:
+            summary = summary + '\nNot found or failed:\n' + '\n'.join(not_found)
+        await timeout_retry(3, update.message.reply_text, summary)
+        self.logger.debug('Batch request from {0} was completed: {1} links'.format(update.message.from_user.id,
+                                                                                   len(targets)))
+
     class SplitArchiver:
-        file = None
-        counter = 1
-        size = 0
-        __SIZE_LIMIT = 0
-        base_name = None
+        COMPRESSION = {'.txt': zipfile.ZIP_DEFLATED}
+        COMPRESSION_TYPES = {'stored': zipfile.ZIP_STORED, 'deflated': zipfile.ZIP_DEFLATED}
+        ENTRY_OVERHEAD = 1024
 
-        def __init__(self, base_name, work_dir, file_size_limit):
+        def __init__(self, base_name, file_size_limit, compression=None, counter=1):
             self.base_name = base_name
-            self.__SIZE_LIMIT = file_size_limit
-            self.work_dir = work_dir
-            pass
+            self.size_limit = file_size_limit
+            self.compression = dict(self.COMPRESSION, **(compression or {}))
+            self.counter = counter
+            self.buffer = None
+            self.file = None
+
+        def _compress_type(self, path):
+            return self.compression.get(os.path.splitext(path)[1].lower(), zipfile.ZIP_STORED)
+
+        def _prepare(self, size):
+            part = None
+            if self.file is not None and self.buffer.tell() + size + self.ENTRY_OVERHEAD >= self.size_limit:
+                part = self.close()
+            if self.file is None:
+                self.buffer = io.BytesIO()
+                self.file = zipfile.ZipFile(self.buffer, 'w')
+            return part
 
-        def write(self, file, path) -> str:
-            name = None
+        def write(self, file, path) -> tuple:
             file_size = os.stat(file).st_size
-            if file_size >= self.__SIZE_LIMIT:
+            if file_size + self.ENTRY_OVERHEAD >= self.size_limit:
                 os.remove(file)
                 return None
+            part = self._prepare(file_size)
+            self.file.write(file, path, compress_type=self._compress_type(path))
+            os.remove(file)
+            return part
 
-            if file_size + self.size >= self.__SIZE_LIMIT:
-                name = self.close()
+        def write_text(self, text, path) -> tuple:
+            data = text.encode('utf-8')
+            part = self._prepare(len(data))
+            self.file.writestr(path, data, compress_type=self._compress_type(path))
+            return part
 
+        def close(self) -> tuple:
             if self.file is None:
-                self.file = zipfile.ZipFile(self.work_dir + self.base_name + '_' + str(self.counter) + '.zip', 'w')
+                return None
+            empty = len(self.file.filelist) == 0
+            self.file.close()
+            self.file = None
+            if empty:
+                return None
+            name = self.base_name + '_' + str(self.counter) + '.zip'
+            self.counter = self.counter + 1
+            return name, self.buffer.getvalue()
 
-            self.file.write(file, path)
-            self.size += file_size
-            os.remove(file)
+    class PartUploader:
+        def __init__(self, job, parts_in_flight, checkpoint, on_delivered, on_uploaded=None):
+            self.job = job
+            self.checkpoint = checkpoint
+            self.parts = checkpoint.parts
+            self.delivered = checkpoint.delivered
+            self.on_delivered = on_delivered
+            self.on_uploaded = on_uploaded
+            self.queue = asyncio.Queue(maxsize=max(1, parts_in_flight - 1))
+            self.task = asyncio.create_task(self._run())
 
-            return name
-
-        def close(self) -> str:
-            if self.file:
-                self.file.close()
-                name = self.file.filename
-                self.file = None
-                if self.size:
-                    self.counter = self.counter + 1
-                    self.size = 0
-                    return name
-            return None
-
-    def save_to_file(self, str, path) -> str:
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        with open(path, "w+", encoding="utf-8") as info_file:
-            info_file.write(str)
-        return path
+        async def _run(self):
+            while True:
+                part = await self.queue.get()
+                if part is None:
+                    return await self.fan_out()
+                (name, data), items = part
+                with METRICS.timer('instasub_telegram_upload_seconds', 'upload', kind='archive'):
+                    message = await timeout_retry(3, self.job.updates[0].message.reply_document, data, filename=name)
+                METRICS.inc('instasub_uploaded_files_total', kind='archive')
+                METRICS.inc('instasub_uploaded_bytes_total', len(data), kind='archive')
+                self.checkpoint.part_delivered(message.document.file_id, items)
+                self.on_delivered()
+                if self.on_uploaded:
+                    self.on_uploaded()
+                await self.fan_out()
 
-    async def download_medias(self, user_id, path):
-        medias = self.ig_tools.get_user_medias(user_id)
-        for media in medias:
+        async def fan_out(self):
+            for index in range(1, len(self.job.updates)):
+                for file_id in self.parts[self.delivered.get(str(index), 0):]:
+                    await timeout_retry(3, self.job.updates[index].message.reply_document, file_id)
+                    self.delivered[str(index)] = self.delivered.get(str(index), 0) + 1
+                    self.on_delivered()
+
+        async def put(self, part):
+            putter = asyncio.create_task(self.queue.put(part))
+            await asyncio.wait({putter, self.task}, return_when=asyncio.FIRST_COMPLETED)
+            if not putter.done():
+                putter.cancel()
+                self.task.result()
+
+        async def finish(self):
+            await self.put(None)
+            await self.task
+
+        def cancel(self):
+            self.task.cancel()
+
+    class ProgressReporter:
+        SECTIONS = {'media': 'posts', 'tagged_media': 'tagged', 'highlights': 'highlights'}
+
+        def __init__(self, message, interval, done=None, total=None):
+            self.logger = logging.getLogger('instasub')
+            self.message = message
+            self.interval = interval
+            self.total = total
+            self.resumed = {section: len(pks) for section, pks in (done or {}).items()}
+            self.sections = dict(self.resumed)
+            self.files = 0
+            self.bytes = 0
+            self.parts = 0
+            self.started = monotonic()
+            self.next_update = self.started + interval
+            self.blocked_until = 0
+            self.task = None
+
+        def item(self, section):
+            self.sections[section] = self.sections.get(section, 0) + 1
+            self.changed()
+
+        def file(self, size):
+            self.files = self.files + 1
+            self.bytes = self.bytes + size
+            self.changed()
+
+        def part(self):
+            self.parts = self.parts + 1
+            self.changed()
+
+        def changed(self):
+            now = monotonic()
+            if now < max(self.next_update, self.blocked_until) or (self.task is not None and not self.task.done()):
+                return
+            self.next_update = now + self.interval
+            self.task = asyncio.create_task(self._edit(self.format()))
+
+        async def _edit(self, text):
             try:
-                download_path = path + 'media/' + media.taken_at.strftime("%d.%m.%y %H-%M-%S") + '/'
-                info_file = self.save_to_file(
-                    self.ig_tools.get_media_info(media) + self.ig_tools.get_media_comments(media),
-                    download_path + media.pk + '.txt')
-                yield info_file
-                files = self.ig_tools.download_media(media, download_path)
-                for file in files:
-                    yield file
-            except Exception as e:
-                self.logger.error('During media download exception occurred:', str(e))
-                self.notify_admin('During media download exception occurred:' + str(e))
-
-    async def download_tagged_medias(self, user_id, path):
-        tagged_medias = self.ig_tools.get_user_tagged_medias(user_id)
-        for tagged_media in tagged_medias:
-            download_path = path + 'tagged_media/' + tagged_media.taken_at.strftime(
-                "%d.%m.%y %H-%M-%S") + '/'
-            info_file = self.save_to_file(
-                self.ig_tools.get_media_info(tagged_media) + self.ig_tools.get_media_comments(tagged_media),
-                download_path + tagged_media.pk + '.txt')
-            yield info_file
-            files = self.ig_tools.download_media(tagged_media, download_path)
-            for file in files:
-                yield file
-
-    async def download_highlights(self, user_id, path):
-        highlights = self.ig_tools.get_highlights(user_id)
-        for highlight in highlights:
-            download_path = path + 'highlights/' + highlight.created_at.strftime(
-                "%d.%m.%y %H-%M-%S") + '/'
-            info_file = self.save_to_file(self.ig_tools.get_highlight_info(highlight),
-                                          download_path + highlight.pk + '.txt')
-            yield info_file
-            files = self.ig_tools.download_highlight(highlight, download_path)
-            for file in files:
-                yield file
-
-    async def download_user_info(self, user_id, path):
-        yield self.save_to_file(self.ig_tools.get_user_info(user_id), path + 'user_info.txt')
-        yield self.ig_tools.get_user_pic(user_id, path)
-
-    async def download_profile_medias(self, user_id, path):
-        combine = stream.merge(self.download_user_info(user_id, path), self.download_medias(user_id, path),
-                               self.download_tagged_medias(user_id, path), self.download_highlights(user_id, path))
-
-        async with combine.stream() as streamer:
-            async for item in streamer:
-                yield item
-
-    async def download_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-        self.ig_tools.set_delay(True)
+                with METRICS.timer('instasub_telegram_progress_seconds', 'progress update'):
+                    await self.message.edit_text(text)
+            except RetryAfter as e:
+                METRICS.inc('instasub_telegram_flood_waits_total')
+                self.blocked_until = monotonic() + e.retry_after
+            except TelegramError as e:
+                self.logger.debug('Progress update skipped: {0}'.format(str(e)))
+
+        def eta(self):
+            done = self.sections.get('media', 0)
+            rate = (done - self.resumed.get('media', 0)) / max(monotonic() - self.started, 1)
+            if not self.total or rate <= 0 or done >= self.total:
+                return None
+            return (self.total - done) / rate
+
+        def format(self) -> str:
+            items = ['{0} {1}'.format(self.sections.get(section, 0), name) for section, name in self.SECTIONS.items()]
+            if self.total:
+                items[0] = '{0} of {1} posts'.format(self.sections.get('media', 0), self.total)
+            lines = ['Downloaded ' + ', '.join(items),
+                     'Files: {0} ({1:.1f} MB), parts sent: {2}'.format(self.files, self.bytes / 1024 / 1024, self.parts)]
+            eta = self.eta()
+            if eta is not None:
+                lines.append('ETA: ~{0} min'.format(int(eta // 60) + 1))
+            return '\n'.join(lines)
+
+        async def wait(self):
+            if self.task is not None:
+                await self.task
+
+        async def flush(self, text):
+            await asyncio.sleep(max(0, self.blocked_until - monotonic()))
+            with METRICS.timer('instasub_telegram_progress_seconds', 'progress update'):
+                await timeout_retry(3, self.message.edit_text, text + '\n' + self.format())
+
+        def cancel(self):
+            if self.task is not None:
+                self.task.cancel()
+
+    async def until_known(self, medias, section, checkpoint, since):
+        known = 0
+        marks = checkpoint.marks
+        async for media, end_cursor in medias:
+            taken_at = media.taken_at.timestamp()
+            if section not in marks or taken_at > marks[section]['taken_at']:
+                marks[section] = {'pk': media.pk, 'taken_at': taken_at}
+            if since and section in since and taken_at <= since[section]['taken_at']:
+                known = known + 1
+                if known > self.PINNED_LIMIT:
+                    return
+                continue
+            if checkpoint.is_done(section, media.pk):
+                continue
+            checkpoint.listed(section, media.pk, end_cursor)
+            yield media
+
+    async def list_medias(self, user_id, path, checkpoint, since=None):
+        async for media in self.until_known(self.ig_tools.iter_user_medias(user_id, checkpoint.cursor('media')),
+                                            'media', checkpoint, since):
+            yield 'media', media, path + 'media/' + media.taken_at.strftime("%d.%m.%y %H-%M-%S") + '/', 'media'
+
+    async def list_tagged_medias(self, user_id, path, checkpoint, since=None):
+        async for tagged_media in self.until_known(
+                self.ig_tools.iter_user_tagged_medias(user_id, checkpoint.cursor('tagged_media')), 'tagged_media',
+                checkpoint, since):
+            yield 'media', tagged_media, path + 'tagged_media/' + tagged_media.taken_at.strftime(
+                "%d.%m.%y %H-%M-%S") + '/', 'tagged_media'
+
+    async def list_highlights(self, user_id, path, checkpoint, since=None):
+        marks = checkpoint.marks
+        highlights = []
+        for highlight in await self.ig_tools.get_highlights(user_id):
+            if 'highlights' not in marks or highlight.latest_reel_media > marks['highlights']['taken_at']:
+                marks['highlights'] = {'pk': highlight.pk, 'taken_at': highlight.latest_reel_media}
+            if since and 'highlights' in since and highlight.latest_reel_media <= since['highlights']['taken_at']:
+                continue
+            if not checkpoint.is_done('highlights', highlight.pk):
+                highlights.append(highlight)
+
+        for i in range(0, len(highlights), self.HIGHLIGHT_BATCH):
+            for highlight in await self.ig_tools.get_highlights_items(highlights[i:i + self.HIGHLIGHT_BATCH]):
+                checkpoint.listed('highlights', highlight.pk)
+                yield 'highlight', highlight, path + 'highlights/' + highlight.created_at.strftime(
+                    "%d.%m.%y %H-%M-%S") + '/', 'highlights'
+
+    async def list_user_info(self, user_id, path, checkpoint):
+        if not checkpoint.is_done('user', user_id):
+            checkpoint.listed('user', user_id)
+            yield 'user', user_id, path, 'user'
+
+    async def fetch_metadata(self, item, emit):
+        kind, obj, download_path, section = item
+        if kind == 'highlight':
+            await emit((download_path + obj.pk + '.txt', await self.ig_tools.get_highlight_info(obj)))
+        elif kind == 'user':
+            await emit((download_path + 'user_info.txt', await self.ig_tools.get_user_info(obj)))
+        yield item
+
+    async def fetch_comments(self, item, emit):
+        kind, obj, download_path, section = item
+        if kind == 'media':
+            info_file = download_path + obj.pk + '.txt'
+            info = await self.ig_tools.get_media_info(obj)
+            os.makedirs(download_path, exist_ok=True)
+            with open(info_file, 'w', encoding='utf-8') as file:
+                file.write(info)
+                await self.ig_tools.write_media_comments(obj, file, self.pipeline_limits['comment_limit'])
+            await emit(info_file)
+        yield item
+
+    async def fetch_files(self, item, emit):
+        kind, obj, download_path, section = item
+        if kind == 'media':
+            files = await self.ig_tools.download_media(obj, download_path)
+        elif kind == 'highlight':
+            files = await self.ig_tools.download_highlight(obj, download_path)
+        else:
+            files = [await self.ig_tools.get_user_pic(obj, download_path)]
+        for file in files:
+            yield file
+        yield ArchivedItem(section, obj if kind == 'user' else obj.pk)
+
+    async def pipeline_error(self, failed, e, item):
+        failed.append(item[3])
+        await self.notify_admin('During profile download exception occurred: ' + str(e))
+
+    async def download_profile_medias(self, user_id, path, checkpoint, since=None, failed=None):
+        pipeline = Pipeline(self.pipeline_limits['output'],
+                            functools.partial(self.pipeline_error, failed if failed is not None else []))
+        pipeline.add_source(self.list_user_info(user_id, path, checkpoint))
+        pipeline.add_source(self.list_medias(user_id, path, checkpoint, since))
+        pipeline.add_source(self.list_tagged_medias(user_id, path, checkpoint, since))
+        pipeline.add_source(self.list_highlights(user_id, path, checkpoint, since))
+        pipeline.add_stage('metadata', self.fetch_metadata, self.pipeline_limits['metadata'])
+        pipeline.add_stage('comments', self.fetch_comments, self.pipeline_limits['comments'])
+        pipeline.add_stage('download', self.fetch_files, self.pipeline_limits['download'])
+
+        async for file in pipeline.run():
+            yield file
+
+    async def download_new_medias(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if len(context.args) != 1:
+            await timeout_retry(3, update.message.reply_text, 'Usage: /new <username>')
+            return
+        try:
+            username = InstagramTools.extract_username(context.args[0])
+        except UserNotFound:
+            return await self.reply_unrecognized(update)
+        await self.enqueue('new', '{0}:{1}'.format(update.message.from_user.id, username.lower()), update)
+
+    async def download_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE, username=None,
+                               since_last_time=False, job=None) -> str:
+        username = username or update.message.text
+        if job is None:
+            job = Job('profile', username, update.message.from_user.id, True)
+            job.updates.append(update)
         try:
             self.logger.debug(
-                'Starting to download account {0} requested by {1}'.format(update.message.text,
+                'Starting to download account {0} requested by {1}'.format(username,
                                                                            update.message.from_user.id))
 
             reply_message = await timeout_retry(3, update.message.reply_text, 'Checking user...')
-            user_id = self.ig_tools.get_user_id(update.message.text)
-            download_path = str(update.update_id) + '/'
-            archiver = self.SplitArchiver(update.message.text, download_path, self.FILE_SIZE_LIMIT)
+            user_id = await self.ig_tools.get_user_id(username)
+            watermark_key = '{0}:{1}'.format(update.message.from_user.id, user_id)
+            stored = self.watermarks.get(watermark_key) or {}
+            since = stored if since_last_time else None
+            checkpoint = self.job_queue.checkpoint(job)
+            if checkpoint.parts:
+                self.logger.info('Resuming job {0} after {1} delivered parts'.format(job.key, len(checkpoint.parts)))
+            download_path = self.work_path(update)
+            archiver = self.SplitArchiver(username, self.FILE_SIZE_LIMIT, self.archive_compression,
+                                          len(checkpoint.parts) + 1)
+            total = None if since else await self.ig_tools.get_user_media_count(user_id)
+            failed = []
+            progress = self.ProgressReporter(reply_message, self.pipeline_limits['progress_interval'], checkpoint.done,
+                                             total)
+            uploader = self.PartUploader(job, self.pipeline_limits['uploads'], checkpoint,
+                                         functools.partial(self.job_queue.save_checkpoint, job, checkpoint),
+                                         progress.part)
 
-            i = 0
-            async for file in self.download_profile_medias(user_id, download_path):
-                archive = archiver.write(file, os.path.relpath(file, download_path))
-                if archive:
-                    await timeout_retry(3, update.message.reply_document, open(archive, 'rb'))
-                    os.remove(archive)
-                i = i + 1
-                try:
-                    await timeout_retry(1, reply_message.edit_text, '{0} medias were downloaded'.format(i))
-                except TimedOut:
-                    pass
+            try:
+                async for file in self.download_profile_medias(user_id, download_path, checkpoint, since, failed):
+                    if isinstance(file, ArchivedItem):
+                        checkpoint.archived(file.section, file.pk)
+                        progress.item(file.section)
+                        continue
+                    with METRICS.timer('instasub_archive_write_seconds', 'archive write'):
+                        if isinstance(file, tuple):
+                            size = len(file[1])
+                            archive = archiver.write_text(file[1], os.path.relpath(file[0], download_path))
+                        else:
+                            size = os.stat(file).st_size
+                            archive = archiver.write(file, os.path.relpath(file, download_path))
+                    progress.file(size)
+                    if archive:
+                        with METRICS.timer('instasub_upload_wait_seconds', 'upload wait'):
+                            await uploader.put((archive, checkpoint.close_part()))
 
-            archive = archiver.close()
-            if archive:
-                await timeout_retry(3, update.message.reply_document, open(archive, 'rb'))
-                os.remove(archive)
+                archive = archiver.close()
+                if archive:
+                    await uploader.put((archive, checkpoint.close_part()))
+                await uploader.finish()
+                await progress.wait()
+            finally:
+                uploader.cancel()
+                progress.cancel()
 
             if os.path.exists(download_path):
                 shutil.rmtree(download_path)
 
-            await timeout_retry(3, reply_message.edit_text, 'Account download completed')
+            # a failed item is older than the new mark, so /new would skip it forever
+            marks = {section: mark for section, mark in checkpoint.marks.items() if section not in failed}
+            self.watermarks.set(watermark_key, dict(stored, **marks))
+            status = 'Account download completed'
+            if failed:
+                status = status + ', {0} items failed'.format(len(failed))
+            await progress.flush(status)
 
             self.logger.debug(
                 'Account download request from {0} was completed successfully: {1}'.format(update.message.from_user.id,
-                                                                                           update.message.text))
+                                                                                           username))
+            return status
         except PrivateAccountException:
-            self.logger.debug('Requested account {0} is private, request from {1} '.format(update.message.text,
+            self.logger.debug('Requested account {0} is private, request from {1} '.format(username,
                                                                                            update.message.from_user.id))
             await timeout_retry(3, reply_message.edit_text, 'The account is private')
+            return 'The account is private'
         except UserNotFound:
-            self.logger.debug('Requested account {0} does not exits, request from {1} '.format(update.message.text,
+            self.logger.debug('Requested account {0} does not exits, request from {1} '.format(username,
                                                                                                update.message.from_user.id))
             await timeout_retry(3, reply_message.edit_text, 'Invalid link or username')
-            raise
+            return 'Invalid link or username'
+
+
+class TestParseTargets(unittest.TestCase):
+    def test_parse_targets(self):
+        self.assertEqual(TelegramTools.parse_targets('NASA'), [('profile', 'nasa')])
+        self.assertEqual(TelegramTools.parse_targets('hello there'), [])
+        self.assertEqual(TelegramTools.parse_targets('check these out: @nasa, @spacex!'),
+                         [('profile', 'nasa'), ('profile', 'spacex')])
+        self.assertEqual(TelegramTools.parse_targets('nasa,\nspacex\nnasa'), [('profile', 'nasa'), ('profile', 'spacex')])
+        self.assertEqual(TelegramTools.parse_targets(
+            'look (https://www.instagram.com/p/ABC/?igsh=1) and https://instagram.com/reel/XYZ, '
+            'https://www.instagram.com/stories/highlights/123/ https://www.instagram.com/stories/nasa/456/ '
+            'https://www.instagram.com/natgeo/ https://example.com/about'),
+            [('media', 'https://www.instagram.com/p/ABC/'), ('media', 'https://instagram.com/reel/XYZ'),
+             ('highlight', 'https://www.instagram.com/stories/highlights/123/'),
+             ('story', 'https://www.instagram.com/stories/nasa/456/'), ('profile', 'natgeo')])
+
+
+class FakeMessage:
+    def __init__(self, chat_id, sent):
+        self.chat_id = chat_id
+        self.sent = sent
+        self.from_user = types.SimpleNamespace(id=chat_id)
+
+    async def reply_text(self, text, **kwargs):
+        self.sent.append((self.chat_id, text))
+        return self
+
+    async def edit_text(self, text, **kwargs):
+        self.sent.append((self.chat_id, text))
+        return self
+
+    async def reply_document(self, document, filename=None, **kwargs):
+        self.sent.append((self.chat_id, filename or document))
+        return types.SimpleNamespace(document=types.SimpleNamespace(file_id='file_{0}'.format(len(self.sent))))
+
+
+class FakeInstagramTools:
+    def __init__(self, medias, tagged_medias):
+        self.medias = medias
+        self.tagged_medias = tagged_medias
+        self.failing = set()
+        self.downloaded = []
+
+    @staticmethod
+    def media(pk, taken_at):
+        return types.SimpleNamespace(pk=pk, taken_at=datetime.datetime.fromtimestamp(taken_at))
+
+    async def get_user_id(self, username) -> str:
+        return '1'
+
+    async def get_user_media_count(self, user_id) -> int:
+        return len(self.medias)
+
+    async def iter_medias(self, medias):
+        for media in medias:
+            yield media, ''
+
+    def iter_user_medias(self, user_id, end_cursor=''):
+        return self.iter_medias(self.medias)
+
+    def iter_user_tagged_medias(self, user_id, end_cursor=''):
+        return self.iter_medias(self.tagged_medias)
+
+    async def get_highlights(self, user_id) -> list:
+        return []
+
+    async def get_user_info(self, user_id) -> str:
+        return 'user'
+
+    async def get_media_info(self, media) -> str:
+        return media.pk
+
+    async def write_media_comments(self, media, file, limit):
+        pass
+
+    async def download_media(self, media, path) -> list:
+        if media.pk in self.failing:
+            self.failing.discard(media.pk)
+            raise RuntimeError('download failed')
+        self.downloaded.append(media.pk)
+        os.makedirs(path, exist_ok=True)
+        with open(path + media.pk + '.jpg', 'wb') as file:
+            file.write(b'media')
+        return [path + media.pk + '.jpg']
+
+    async def get_user_pic(self, user_id, path) -> str:
+        os.makedirs(path, exist_ok=True)
+        with open(path + 'user.jpg', 'wb') as file:
+            file.write(b'user')
+        return path + 'user.jpg'
+
+
+class TestWatermarks(unittest.TestCase):
+    def test_until_known_skips_pinned_and_stops(self):
+        async def collect(telegram_tools, medias, since):
+            checkpoint = Checkpoint()
+            consumed = []
+
+            async def listed():
+                for media in medias:
+                    consumed.append(media.pk)
+                    yield media, ''
+
+            found = [media.pk async for media in telegram_tools.until_known(listed(), 'media', checkpoint, since)]
+            return found, consumed, checkpoint.marks
+
+        media = FakeInstagramTools.media
+        telegram_tools = TelegramTools('0:test', 0, None, None, None, None, JobQueue(None))
+        medias = [media('pinned', 50), media('new2', 300), media('new1', 200)] + [
+            media('old{0}'.format(i), 100 - i) for i in range(10)]
+        found, consumed, marks = asyncio.run(collect(telegram_tools, medias, {'media': {'pk': 'x', 'taken_at': 100}}))
+        self.assertEqual(found, ['new2', 'new1'])
+        self.assertEqual(consumed, ['pinned', 'new2', 'new1', 'old0', 'old1', 'old2'])
+        self.assertEqual(marks, {'media': {'pk': 'new2', 'taken_at': 300}})
+        found, consumed, marks = asyncio.run(collect(telegram_tools, medias, None))
+        self.assertEqual(len(found), len(medias))
+
+    def test_failed_section_keeps_its_watermark(self):
+        media = FakeInstagramTools.media
+        ig_tools = FakeInstagramTools([media('m2', 200), media('m1', 100)], [media('t2', 200), media('t1', 100)])
+
+        async def download(telegram_tools, kind, update_id):
+            job = Job(kind, '1:user', 1, True)
+            job.updates.append(types.SimpleNamespace(update_id=update_id, message=FakeMessage(1, [])))
+            return await telegram_tools.download_profile(job.updates[0], None, 'user', kind == 'new', job)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            watermarks = PersistentLRUCache(os.path.join(work_dir, 'watermarks.json'), 10)
+            try:
+                telegram_tools = TelegramTools('0:test', 0, ig_tools, None, watermarks, None,
+                                               JobQueue(JobStore(os.path.join(work_dir, 'jobs.sqlite'))),
+                                               work_dir=os.path.join(work_dir, 'work/'))
+                telegram_tools.notify_admin = lambda message: asyncio.sleep(0)
+                watermarks.set('1:1', {'tagged_media': {'pk': 't0', 'taken_at': 50}})
+                ig_tools.failing.add('t2')
+                self.assertEqual(asyncio.run(download(telegram_tools, 'profile', 1)),
+                                 'Account download completed, 1 items failed')
+                self.assertEqual(watermarks.get('1:1'), {'tagged_media': {'pk': 't0', 'taken_at': 50},
+                                                         'media': {'pk': 'm2', 'taken_at': 200}})
+                ig_tools.downloaded.clear()
+                self.assertEqual(asyncio.run(download(telegram_tools, 'new', 2)), 'Account download completed')
+                self.assertEqual(sorted(ig_tools.downloaded), ['t1', 't2'])
+                self.assertEqual(watermarks.get('1:1')['tagged_media'], {'pk': 't2', 'taken_at': 200})
+            finally:
+                watermarks.close()
+
+
+class TestRunProfileJob(unittest.TestCase):
+    def test_every_requester_gets_the_outcome(self):
+        async def get_user_id(username):
+            raise {'private': PrivateAccountException(), 'missing': UserNotFound(),
+                   'broken': RuntimeError('broken')}[username]
+
+        async def run(username):
+            sent = []
+            job = Job('profile', username, 1, True)
+            job.updates = [types.SimpleNamespace(update_id=chat_id, message=FakeMessage(chat_id, sent))
+                           for chat_id in (1, 2)]
+            try:
+                await telegram_tools.run_profile_job(job)
+            except RuntimeError:
+                pass
+            return sent
+
+        telegram_tools = TelegramTools('0:test', 0, types.SimpleNamespace(get_user_id=get_user_id), None, None, None,
+                                       JobQueue(None))
+        self.assertEqual(asyncio.run(run('private')), [(1, 'Checking user...'), (1, 'The account is private'),
+                                                       (2, 'The account is private')])
+        self.assertEqual(asyncio.run(run('missing')), [(1, 'Checking user...'), (1, 'Invalid link or username'),
+                                                       (2, 'Invalid link or username')])
+        self.assertEqual(asyncio.run(run('broken')), [(1, 'Checking user...'), (1, 'Account download failed'),
+                                                      (2, 'Account download failed')])
+
+
+class TestReclaimWorkDirs(unittest.TestCase):
+    def test_only_the_work_dir_is_reclaimed(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            work_dir = os.path.join(temp_dir, 'work/')
+            for path in ('work/123/media', 'work/subscriptions/1', '456'):
+                os.makedirs(os.path.join(temp_dir, path))
+            telegram_tools = TelegramTools('0:test', 0, None, None, None, None, JobQueue(None), work_dir=work_dir)
+            telegram_tools.reclaim_work_dirs()
+            self.assertEqual(sorted(os.listdir(temp_dir)), ['456', 'work'])
+            self.assertEqual(os.listdir(work_dir), [])
+            self.assertEqual(telegram_tools.work_path(types.SimpleNamespace(update_id=7)), work_dir + '7/')
+
+
+class TestSplitArchiver(unittest.TestCase):
+    @staticmethod
+    def media_file(path, size) -> str:
+        with open(path, 'wb') as file:
+            file.write(os.urandom(size))
+        return path
+
+    def test_parts_roll_over_at_the_size_limit(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archiver = TelegramTools.SplitArchiver('user', 4000)
+            parts = [archiver.write(self.media_file(os.path.join(temp_dir, '{0}.jpg'.format(i)), 1500),
+                                    'media/{0}.jpg'.format(i)) for i in range(3)]
+            self.assertIsNone(archiver.write(self.media_file(os.path.join(temp_dir, 'big.mp4'), 4000), 'big.mp4'))
+            parts.append(archiver.close())
+            self.assertEqual(os.listdir(temp_dir), [])
+        self.assertIsNone(parts[0])
+        self.assertEqual([name for name, data in parts[1:]], ['user_1.zip', 'user_2.zip', 'user_3.zip'])
+        for i, (name, data) in enumerate(parts[1:]):
+            self.assertLess(len(data), 4000)
+            self.assertEqual(zipfile.ZipFile(io.BytesIO(data)).namelist(), ['media/{0}.jpg'.format(i)])
+        self.assertIsNone(archiver.close())
+
+    def test_compression_by_extension(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            archiver = TelegramTools.SplitArchiver('user', 1024 * 1024, {'.jpg': zipfile.ZIP_DEFLATED}, counter=4)
+            archiver.write_text('text ' * 1000, 'info.txt')
+            archiver.write(self.media_file(os.path.join(temp_dir, 'photo.jpg'), 100), 'photo.jpg')
+            archiver.write(self.media_file(os.path.join(temp_dir, 'video.MP4'), 100), 'video.MP4')
+            name, data = archiver.close()
+        self.assertEqual(name, 'user_4.zip')
+        self.assertEqual({info.filename: info.compress_type for info in zipfile.ZipFile(io.BytesIO(data)).infolist()},
+                         {'info.txt': zipfile.ZIP_DEFLATED, 'photo.jpg': zipfile.ZIP_DEFLATED,
+                          'video.MP4': zipfile.ZIP_STORED})
+
+
+class TestPartUploader(unittest.TestCase):
+    class SlowMessage(FakeMessage):
+        def __init__(self, chat_id, sent, release):
+            super().__init__(chat_id, sent)
+            self.release = release
+
+        async def reply_document(self, document, filename=None, **kwargs):
+            await self.release.wait()
+            return await super().reply_document(document, filename, **kwargs)
+
+    def test_parts_are_delivered_in_order_with_bounded_buffering(self):
+        async def run():
+            sent = []
+            release = asyncio.Event()
+            job = Job('profile', 'user', 1, True)
+            job.updates = [types.SimpleNamespace(message=self.SlowMessage(1, sent, release)),
+                           types.SimpleNamespace(message=FakeMessage(2, sent))]
+            checkpoint = Checkpoint()
+            delivered = []
+            uploader = TelegramTools.PartUploader(job, 2, checkpoint, lambda: delivered.append(len(sent)))
+            parts = [(('user_{0}.zip'.format(i), b'data'), [('media', str(i))]) for i in range(1, 4)]
+            await uploader.put(parts[0])
+            await uploader.put(parts[1])
+            third = asyncio.create_task(uploader.put(parts[2]))
+            await asyncio.sleep(0.01)
+            # one part is uploading and one is buffered, so the next producer waits
+            self.assertFalse(third.done())
+            release.set()
+            await third
+            job.updates.append(types.SimpleNamespace(message=FakeMessage(3, sent)))
+            await uploader.finish()
+            return sent, checkpoint, delivered
+
+        sent, checkpoint, delivered = asyncio.run(run())
+        self.assertEqual([filename for chat_id, filename in sent if chat_id == 1],
+                         ['user_1.zip', 'user_2.zip', 'user_3.zip'])
+        self.assertEqual(checkpoint.parts, ['file_1', 'file_3', 'file_5'])
+        self.assertEqual([file_id for chat_id, file_id in sent if chat_id == 2], checkpoint.parts)
+        self.assertEqual([file_id for chat_id, file_id in sent if chat_id == 3], checkpoint.parts)
+        self.assertEqual(checkpoint.done, {'media': {'1', '2', '3'}})
+        self.assertEqual(checkpoint.delivered, {'1': 3, '2': 3})
+        self.assertEqual(len(delivered), 9)
+
+    def test_upload_error_stops_the_producer(self):
+        class FailingMessage(FakeMessage):
+            async def reply_document(self, document, filename=None, **kwargs):
+                raise TelegramError('upload failed')
+
+        async def run():
+            job = Job('profile', 'user', 1, True)
+            job.updates = [types.SimpleNamespace(message=FailingMessage(1, []))]
+            uploader = TelegramTools.PartUploader(job, 2, Checkpoint(), lambda: None)
+            for i in range(3):
+                await uploader.put((('user_{0}.zip'.format(i), b'data'), []))
+
+        self.assertRaises(TelegramError, asyncio.run, run())
+
+
+class TestRun(unittest.TestCase):
+    class FakeApplication:
+        def __init__(self, outcomes):
+            self.outcomes = outcomes
+            self.loops = []
+
+        def run_polling(self):
+            loop = asyncio.get_event_loop()
+            self.loops.append((loop, loop.is_closed()))
+            loop.close()
+            outcome = self.outcomes.pop(0)
+            if outcome is not None:
+                raise outcome
+
+    def test_restarts_with_backoff_until_clean_stop(self):
+        telegram_tools = TelegramTools('0:test', 0, None, None, None, None, JobQueue(None))
+        telegram_tools.application = self.FakeApplication([RuntimeError('Event loop is closed')] * 3 + [None])
+        notified, delays = [], []
+        telegram_tools.notify_admin_outside_loop = notified.append
+        with mock.patch(__name__ + '.sleep', delays.append):
+            telegram_tools.run()
+        loops = telegram_tools.application.loops
+        self.assertEqual(len(loops), 4)
+        self.assertEqual(len({id(loop) for loop, closed in loops}), 4)
+        self.assertFalse(any(closed for loop, closed in loops))
+        self.assertEqual(notified, ['Event loop is closed'])
+        self.assertEqual(delays, [1, 2, 4])
+
+
+class TestWebhook(unittest.TestCase):
+    class FakeRequest(BaseRequest):
+        def __init__(self):
+            self.calls = []
+            self.loop = None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None) -> tuple:
+            self.loop = asyncio.get_running_loop()
+            endpoint = url.rsplit('/', 1)[1]
+            self.calls.append((endpoint, request_data.parameters if request_data else {}))
+            user = {'id': 1, 'is_bot': True, 'first_name': 'bot', 'username': 'bot'}
+            if endpoint == 'getMe':
+                result = user
+            elif endpoint == 'sendMessage':
+                result = {'message_id': 2, 'date': 0, 'chat': {'id': 5, 'type': 'private'}, 'from': user,
+                          'text': request_data.parameters['text']}
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode('utf-8')
+
+    @staticmethod
+    def free_port() -> int:
+        with socket.socket() as listener:
+            listener.bind(('127.0.0.1', 0))
+            return listener.getsockname()[1]
+
+    @staticmethod
+    def post(url, data, secret_token=None) -> int:
+        headers = {'Content-Type': 'application/json'}
+        if secret_token:
+            headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, data, headers), timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_updates_are_posted_to_the_listener(self):
+        request = self.FakeRequest()
+
+        class WebhookTelegramTools(TelegramTools):
+            @staticmethod
+            def application_builder():
+                return Application.builder().request(request).get_updates_request(request)
+
+        async def start():
+            pass
+
+        async def run(send):
+            pass
+
+        port = self.free_port()
+        update = json.dumps({'update_id': 1, 'message': {
+            'message_id': 1, 'date': 0, 'chat': {'id': 5, 'type': 'private'},
+            'from': {'id': 5, 'is_bot': False, 'first_name': 'user'}, 'text': '/help',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]}}).encode('utf-8')
+        url = 'http://127.0.0.1:{0}/telegram'.format(port)
+        statuses = []
+
+        def client():
+            try:
+                deadline = monotonic() + 10
+                while request.loop is None or not any(call[0] == 'setWebhook' for call in request.calls):
+                    self.assertLess(monotonic(), deadline)
+                    sleep(0.05)
+                while True:
+                    try:
+                        statuses.append(self.post(url, update, 'secret'))
+                        break
+                    except urllib.error.URLError:
+                        self.assertLess(monotonic(), deadline)
+                        sleep(0.05)
+                while not any(call[0] == 'sendMessage' for call in request.calls):
+                    self.assertLess(monotonic(), deadline)
+                    sleep(0.05)
+                statuses.append(self.post(url, update))
+                statuses.append(self.post(url, update, 'wrong'))
+            finally:
+                request.loop.call_soon_threadsafe(request.loop.stop)
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            file_id_cache = PersistentLRUCache(os.path.join(work_dir, 'file_ids.json'), 10)
+            watermarks = PersistentLRUCache(os.path.join(work_dir, 'watermarks.json'), 10)
+            scheduler = types.SimpleNamespace(run=run, store=types.SimpleNamespace(flush=lambda: None))
+            telegram_tools = WebhookTelegramTools(
+                '0:test', 0, types.SimpleNamespace(start=start), file_id_cache, watermarks, scheduler,
+                JobQueue(JobStore(os.path.join(work_dir, 'jobs.sqlite'))),
+                webhook={'listen': '127.0.0.1', 'port': port, 'webhook_url': 'https://example.com/telegram',
+                         'secret_token': 'secret'}, work_dir=os.path.join(work_dir, 'work/'))
+            thread = threading.Thread(target=client)
+            thread.start()
+            try:
+                telegram_tools.run()
+            finally:
+                thread.join()
+                file_id_cache.close()
+                watermarks.close()
+
+        self.assertEqual(statuses, [200, 403, 403])
+        set_webhook = next(parameters for endpoint, parameters in request.calls if endpoint == 'setWebhook')
+        self.assertEqual(set_webhook['url'], 'https://example.com/telegram')
+        self.assertEqual(set_webhook['secret_token'], 'secret')
+        self.assertEqual([parameters['chat_id'] for endpoint, parameters in request.calls
+                          if endpoint == 'sendMessage'], [5])
+
 
-        self.ig_tools.set_delay(False)
+if __name__ == '__main__':
+    unittest.main()